@@ -0,0 +1,138 @@
+"""In-process caches for parsed scenario files."""
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class VersionedCache:
+    """Bounded LRU cache whose entries are rebuilt when their version changes.
+
+    build(stale) is called with the outdated (version, value) of the key, or None, so builders can extend
+    the previous value instead of starting over.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (version, value)
+        self._lock = threading.Lock()
+
+    def lookup(self, key, version, build):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = build(entry)
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+class FileCache(VersionedCache):
+    """Bounded LRU cache of parsed files.
+
+    Each entry is keyed by file path and remembers the file's mtime, so a file
+    that is edited on disk is parsed again on its next lookup. Values are
+    shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self, loader, maxsize=128):
+        super().__init__(maxsize)
+        self.loader = loader  # loader(path) -> parsed value
+
+    def get(self, path):
+        mtime = os.stat(path).st_mtime_ns  # raises FileNotFoundError like open() would
+        return self.lookup(path, mtime, lambda stale: self.loader(path))
+
+
+class DirectoryIndex:
+    """Entries built from the subdirectories of a directory, kept in memory.
+
+    load(name) builds the entry of subdirectory name and runs on a thread pool. The index is rebuilt
+    when a subdirectory is added or removed, or when the file(name) of one changes, checked at most
+    every interval seconds. load should return None for a subdirectory it can't read.
+    """
+
+    def __init__(self, root, load, file, workers=8, interval=2.0):
+        self.root = root
+        self.load = load
+        self.file = file  # file(name) -> path whose mtime versions the entry
+        self.workers = workers
+        self.interval = interval
+        self.version = 0  # bumped on every rebuild
+        self.builds = 0
+        self.last_build = 0.0  # seconds
+        self.total_build = 0.0
+        self._entries = {}
+        self._signature = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def signature(self):
+        names = sorted(d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d)))
+        mtimes = []
+        for name in names:
+            try:
+                mtimes.append(os.stat(self.file(name)).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return tuple(zip(names, mtimes))
+
+    def refresh(self):
+        # rebuild if the directory changed, returns the version
+        now = time.monotonic()
+        with self._lock:
+            if self._checked is not None and now - self._checked < self.interval:
+                return self.version
+        signature = self.signature()
+        with self._lock:
+            self._checked = now
+            if signature == self._signature:
+                return self.version
+        start = time.perf_counter()
+        names = [name for name, mtime in signature]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(names)))) as pool:
+            values = list(pool.map(self.load, names))
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._entries = {n: v for n, v in zip(names, values) if v is not None}
+            self._signature = signature
+            self.version += 1
+            self.builds += 1
+            self.last_build = elapsed
+            self.total_build += elapsed
+            return self.version
+
+    def entries(self):
+        # {name: entry}, sorted by name
+        self.refresh()
+        return self._entries
+
+    def stats(self):
+        with self._lock:
+            return {'version': self.version, 'entries': len(self._entries), 'builds': self.builds,
+                    'last_build_ms': round(self.last_build * 1000, 3),
+                    'total_build_ms': round(self.total_build * 1000, 3)}
@@ -0,0 +1,53 @@
+"""Gradebook exports of one or many scenarios as csv or parquet."""
+import csv
+import io
+
+from flask import Response, abort, stream_with_context
+
+from .grading_utils import gradebook
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # parquet exports need pyarrow
+    pa = None
+    pq = None
+
+GRADEBOOK_COLUMNS = ("scenario_id", "scenario", "user_id", "username", "attempt", "answered", "earned", "total")
+
+
+def gradebookCsv(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(GRADEBOOK_COLUMNS)
+    for r in rows:
+        writer.writerow([r[c] for c in GRADEBOOK_COLUMNS])
+        if buf.tell() > 64 * 1024:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def gradebookParquet(rows):
+    table = pa.table({c: [r[c] for r in rows] for c in GRADEBOOK_COLUMNS})
+    buf = io.BytesIO()
+    pq.write_table(table, buf)
+    return buf.getvalue()
+
+
+def gradebookResponse(scenarios, fname, fmt="csv"):
+    """Scores of every attempt in scenarios, a list of (id, name, type), as a csv or parquet download."""
+    if fmt not in ("csv", "parquet"):
+        abort(400)
+    if fmt == "parquet" and pa is None:
+        abort(501)
+    rows = gradebook(scenarios)
+    if fmt == "parquet":
+        response = Response(gradebookParquet(rows), mimetype="application/vnd.apache.parquet")
+    else:
+        response = Response(stream_with_context(gradebookCsv(rows)), mimetype="text/csv")
+    # quoted (and utf-8 encoded if needed) by werkzeug, names come from users so control characters are dropped
+    fname = "".join(c for c in fname if c.isprintable())
+    response.headers.set("Content-Disposition", "attachment", filename="{0}.{1}".format(fname, fmt))
+    return response
@@ -0,0 +1,233 @@
+"""Compiled scenario questions used to grade student responses."""
+import yaml
+from sqlalchemy import func
+
+from edurange_refactored.extensions import db
+
+from .cache_utils import FileCache
+from .user.models import Responses, User
+
+
+class Question:
+    """A single entry of a scenario's questions.yml, with its accepted answers precomputed."""
+
+    def __init__(self, item):
+        self.order = int(item['Order'])
+        self.text = item['Text']
+        self.type = str(item.get('Type'))
+        self.points = int(item['Points'])
+        self.multi = self.type == "Multi String"
+        single = len(item['Values']) == 1
+        # (answer, points) in yml order, a single answer is worth the question's points
+        self.values = [(str(v['Value']), self.points if single else int(v.get('Points', self.points)))
+                       for v in item['Values']]
+        self.answer = self.values[0][0] if self.values else None  # answer shown to instructors
+        self.essay = single and self.answer == 'ESSAY'
+        self.accepted = {}  # literal answer -> points
+        self.templated = []  # (answer, points) for answers with ${...} placeholders, resolved per player
+        self.index = {}  # answer -> position in values, multi string answers are scored separately
+        for i, (value, pts) in enumerate(self.values):
+            self.index.setdefault(value, i)
+            if "${" in value:
+                self.templated.append((value, pts))
+            else:
+                self.accepted.setdefault(value, pts)
+
+    def match(self, resp, resolve=None):
+        """(position in values, points) of the answer resp matches, (None, 0) if it is wrong.
+
+        resolve(answer) expands a templated answer for the current player.
+        """
+        if self.essay:
+            return 0, self.points
+        pts = self.accepted.get(resp)
+        if pts is not None:
+            return self.index[resp], pts
+        if resolve is not None:
+            for value, pts in self.templated:
+                if resolve(value) == resp:
+                    return self.index[value], pts
+        return None, 0
+
+    def check(self, resp, resolve=None):
+        """Points earned by resp. resolve(answer) expands a templated answer for the current player."""
+        return self.match(resp, resolve)[1]
+
+    def scoreKey(self, resp):
+        # every correct value of a multi string question is scored once, other questions only once
+        if self.multi:
+            return self.order, resp
+        return self.order
+
+    def slot(self, resp, resolve=None):
+        # bit of a correct resp in a progress bitmap, multi string questions get one bit per value
+        if not self.multi:
+            return self.bit
+        i, pts = self.match(resp, resolve)
+        if i is None:  # a templated answer that can't be resolved any more
+            i = self.index[self.templated[0][0]] if self.templated else 0
+        return self.bit + i
+
+    @property
+    def mask(self):
+        width = len(self.values) if self.multi else 1
+        return ((1 << width) - 1) << self.bit
+
+
+class QuestionSet:
+    """questionReader() output indexed by question order."""
+
+    def __init__(self, document):
+        self.questions = {}
+        bit = 0
+        for item in document or []:
+            q = Question(item)
+            q.bit = bit
+            bit += len(q.values) if q.multi else 1
+            self.questions[q.order] = q
+        self.total_points = sum(q.points for q in self.questions.values())
+
+    def get(self, order):
+        return self.questions.get(int(order))
+
+    def __iter__(self):
+        return iter(self.questions.values())
+
+    def __len__(self):
+        return len(self.questions)
+
+    def __contains__(self, order):
+        return int(order) in self.questions
+
+    def scoreKey(self, qnum, resp):
+        q = self.get(qnum)
+        if q is None:
+            return int(qnum)
+        return q.scoreKey(resp)
+
+    def tally(self, responses):
+        """Score responses (question, points, student_response), counting the first correct answer only.
+
+        Returns (points earned, number of questions answered correctly).
+        """
+        seen = set()
+        answered = set()
+        earned = 0
+        for r in responses:
+            if r.points > 0:
+                key = self.scoreKey(r.question, r.student_response)
+                if key not in seen:
+                    seen.add(key)
+                    answered.add(int(r.question))
+                    earned += int(r.points)
+        return earned, len(answered)
+
+    def record(self, mask, qnum, resp, points, resolve=None):
+        """Apply one response to a progress bitmap of first correct answers.
+
+        resolve(answer) expands templated answers, so each templated value of a multi string question
+        gets its own bit like tally() counts them.
+
+        Returns (new mask, points earned, 1 if the question is answered for the first time else 0).
+        """
+        q = self.get(qnum)
+        if q is None or points <= 0:
+            return mask, 0, 0
+        bit = 1 << q.slot(resp, resolve)
+        if mask & bit:
+            return mask, 0, 0  # already scored
+        answered = 0 if mask & q.mask else 1
+        return mask | bit, int(points), answered
+
+
+def compileQuestions(questions):
+    # accepts a QuestionSet or the raw list read from questions.yml
+    if isinstance(questions, QuestionSet):
+        return questions
+    return QuestionSet(questions)
+
+
+def loadQuestionSet(path):
+    with open(path, "r") as yml:
+        return QuestionSet(yaml.full_load(yml))
+
+
+# compiled questions.yml, indexed by question order
+questionCache = FileCache(loadQuestionSet, maxsize=256)
+
+
+def questionSet(name):
+    name = "".join(e for e in name if e.isalnum())
+    return questionCache.get("./data/tmp/" + name + "/questions.yml")
+
+
+def scenarioQuestions(name, s_type):
+    # questions of a built scenario, or of its type in ./scenarios/prod/ once its tmp files are cleaned up
+    try:
+        return questionSet(name)
+    except FileNotFoundError:
+        if not s_type:
+            raise
+    t = s_type.lower().replace(" ", "_")
+    return questionCache.get("./scenarios/prod/" + t + "/questions.yml")
+
+
+def scoreString(earned, questions):
+    return '' + str(earned) + ' / ' + str(questions.total_points)
+
+
+def gradeAttempts(rows, questions):
+    """Score every (user, attempt) found in rows in a single pass.
+
+    rows need id, user_id, attempt, username, question, points and student_response.
+    Returns the same list of dicts as utils.queryPolish, in the order attempts first appear,
+    with the numbers behind the score in earned, total and answered.
+    """
+    questions = compileQuestions(questions)
+    attempts = {}  # (user_id, attempt) -> rows, dicts keep insertion order
+    for r in rows:
+        attempts.setdefault((r.user_id, r.attempt), []).append(r)
+    graded = []
+    for (uid, att), resps in attempts.items():
+        earned, answered = questions.tally(resps)
+        graded.append({'id': resps[0].id, 'user_id': uid, 'username': resps[0].username,
+                       'score': scoreString(earned, questions), 'attempt': att,
+                       'earned': earned, 'total': questions.total_points, 'answered': answered})
+    return graded
+
+
+def scenarioAnswers(*sids):
+    # distinct answers per (scenario, user, attempt, question), grouped by the database
+    # so the rows handed to gradeAttempts shrink from every submission to every distinct answer
+    db_ses = db.session
+    first = func.min(Responses.id)
+    return db_ses.query(first.label('id'), Responses.scenario_id, Responses.user_id, Responses.attempt, User.username,
+                        Responses.question, Responses.student_response, func.max(Responses.points).label('points'))\
+        .filter(Responses.scenario_id.in_(sids)).filter(Responses.user_id == User.id)\
+        .group_by(Responses.scenario_id, Responses.user_id, User.username, Responses.attempt, Responses.question,
+                  Responses.student_response)\
+        .order_by(Responses.scenario_id, first).all()
+
+
+def gradebook(scenarios):
+    """Every (scenario, user, attempt) with its score, from one grouped query over the responses.
+
+    scenarios is a list of (id, name, type). Questions come from scenarioQuestions, so scenarios whose tmp
+    files are gone are still graded; scenarios without any questions.yml are left out.
+    """
+    if not scenarios:
+        return []
+    rows = {}
+    for r in scenarioAnswers(*[sid for sid, name, s_type in scenarios]):
+        rows.setdefault(r.scenario_id, []).append(r)
+    graded = []
+    for sid, name, s_type in scenarios:
+        try:
+            questions = scenarioQuestions(name, s_type)
+        except FileNotFoundError:
+            continue
+        for attempt in gradeAttempts(rows.get(sid, []), questions):
+            attempt['scenario_id'] = sid
+            attempt['scenario'] = name
+            graded.append(attempt)
+    return graded
@@ -0,0 +1,407 @@
+"""Copies scenario bash history logs into the bash_history table."""
+import csv
+import datetime as dt
+import io
+import os
+import threading
+import zlib
+
+from flask import Response, abort, current_app, request, stream_with_context
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from edurange_refactored.extensions import db
+
+from .graph_utils import getLogFile
+from .pagination_utils import encodeCursor
+from .user.models import BashHistory, LogCheckpoints
+
+# columns of <scenario>-history.csv, in file order (player is column 4, as used by groupCSV(rc, 4))
+HISTORY_COLUMNS = ("container_name", "timestamp", "current_directory", "prompt", "player", "input", "output")
+QUOTECHAR = "%"
+CHUNK_SIZE = 4 * 1024 * 1024  # bytes read from a log at a time
+BATCH_SIZE = 1000  # rows per executemany
+
+history = BashHistory.__table__
+# longest value each column takes, longer values are cut
+LIMITS = {c.name: c.type.length for c in history.columns if getattr(c.type, "length", None)}
+
+
+def historyPath(sName):
+    # log file of a scenario relative to the working directory, None if there is none
+    logs = getLogFile(sName)  # '../data/tmp/<scenario>/<scenario>-history.csv'
+    if logs is None:
+        return None
+    return logs[3:]
+
+
+def completeRecords(data):
+    # length of the start of data made only of whole csv records, i.e. ending on a newline outside of quotes
+    # only \n ends a line, output often carries bare \r (progress bars) inside a record
+    quote = QUOTECHAR.encode()
+    pos = end = 0
+    quoted = False
+    while True:
+        nl = data.find(b"\n", pos)
+        if nl == -1:
+            break  # rest is still being written
+        if data.count(quote, pos, nl) % 2:
+            quoted = not quoted
+        pos = nl + 1
+        if not quoted:
+            end = pos
+    return end
+
+
+def readRecords(f, offset):
+    # (length, text) of the whole records of f from offset on, (0, "") if there is none yet
+    readSize = CHUNK_SIZE
+    while True:
+        f.seek(offset)
+        data = f.read(readSize)
+        end = completeRecords(data)
+        if end or len(data) < readSize:
+            return end, data[:end].decode("utf-8", "replace")
+        readSize *= 2  # a single record larger than the chunk
+
+
+def splitRecords(text):
+    # whole records of text, split on newlines outside of quotes like completeRecords
+    pos = start = 0
+    quoted = False
+    while True:
+        nl = text.find("\n", pos)
+        if nl == -1:
+            break
+        if text.count(QUOTECHAR, pos, nl) % 2:
+            quoted = not quoted
+        pos = nl + 1
+        if not quoted:
+            yield text[start:pos]
+            start = pos
+
+
+def parseRecord(record):
+    # fields of one csv record, None if it can't be read
+    # a bare \r (terminal output) in an unquoted field is dropped rather than losing the command
+    for attempt in (record, record.replace("\r\n", "\n").replace("\r", "")):
+        try:
+            return next(csv.reader([attempt], delimiter=",", quotechar=QUOTECHAR), [])
+        except csv.Error:
+            continue
+    return None
+
+
+def csvRecords(text):
+    # fields of each record of text, None for a record that can't be read
+    for record in splitRecords(text):
+        fields = parseRecord(record)
+        if fields != []:
+            yield fields
+
+
+def parseTimestamp(value):
+    # None if value is neither a unix time nor an iso date
+    try:
+        return dt.datetime.utcfromtimestamp(float(value))
+    except (ValueError, OverflowError, OSError):
+        pass
+    try:
+        return dt.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def historyRow(sName, fields):
+    # bash_history row of a csv record, None if its timestamp can't be read
+    row = {"scenario_name": sName}
+    for name, value in zip(HISTORY_COLUMNS, fields):
+        row[name] = value
+    for name in HISTORY_COLUMNS[len(fields):]:
+        row[name] = ""  # short line
+    row["timestamp"] = parseTimestamp(row["timestamp"])
+    if row["timestamp"] is None:
+        return None
+    for name, length in LIMITS.items():
+        if isinstance(row.get(name), str) and len(row[name]) > length:
+            row[name] = row[name][:length]
+    return row
+
+
+def lockCheckpoint(path):
+    db_ses = db.session
+    checkpoint = db_ses.query(LogCheckpoints).filter(LogCheckpoints.path == path).with_for_update().first()
+    if checkpoint is None:
+        try:
+            with db_ses.begin_nested():
+                db_ses.add(LogCheckpoints(path=path, offset=0))
+        except IntegrityError:
+            pass  # created by a concurrent ingest
+        checkpoint = db_ses.query(LogCheckpoints).filter(LogCheckpoints.path == path).with_for_update().first()
+    return checkpoint
+
+
+def ingestHistory(sName):
+    """Copy the lines added to a scenario's history log since the last call into bash_history.
+
+    The byte offset reached is stored in log_checkpoints with each batch, so every line is inserted once
+    even across processes, and a line still being written is left for the next call.
+    Returns the number of rows added, raises FileNotFoundError if the scenario has no log.
+    """
+    path = historyPath(sName)
+    if path is None:
+        raise FileNotFoundError(sName)
+    db_ses = db.session
+    size = os.path.getsize(path)
+    checkpoint = lockCheckpoint(path)
+    if size < checkpoint.offset:  # log was recreated, start over
+        db_ses.query(BashHistory).filter(BashHistory.scenario_name == sName).delete(synchronize_session=False)
+        checkpoint.offset = 0
+    added = skipped = 0
+    with open(path, "rb") as f:
+        while True:
+            end, text = readRecords(f, checkpoint.offset)
+            if end == 0:
+                break  # only a record still being written is left
+            batch = []
+            for fields in csvRecords(text):
+                row = historyRow(sName, fields) if fields is not None else None
+                if row is None:
+                    skipped += 1
+                    continue
+                batch.append(row)
+                if len(batch) >= BATCH_SIZE:
+                    db_ses.execute(history.insert(), batch)
+                    added += len(batch)
+                    batch = []
+            if batch:
+                db_ses.execute(history.insert(), batch)
+                added += len(batch)
+            checkpoint.offset += end
+            checkpoint.updated_at = dt.datetime.utcnow()
+            db_ses.commit()  # rows and offset together
+            checkpoint = lockCheckpoint(path)
+    db_ses.commit()
+    if skipped:
+        current_app.logger.warning("%s: skipped %d unreadable history records", sName, skipped)
+    return added
+
+
+ingesting = set()  # scenarios with an ingestLater thread running in this process
+ingestingLock = threading.Lock()
+
+
+def ingestLater(sName):
+    """Run ingestHistory for a scenario on a thread, so requests never wait for a large log to be copied.
+
+    At most one thread per scenario runs at a time. Returns False if one is already running.
+    """
+    app = current_app._get_current_object()
+    with ingestingLock:
+        if sName in ingesting:
+            return False
+        ingesting.add(sName)
+
+    def run():
+        with app.app_context():
+            try:
+                ingestHistory(sName)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                app.logger.exception("%s: history ingest failed", sName)
+            finally:
+                db.session.remove()
+                with ingestingLock:
+                    ingesting.discard(sName)
+
+    threading.Thread(target=run, name="ingest-" + sName, daemon=True).start()
+    return True
+
+
+def playerHistory(sName, player):
+    # one player's commands, in csv column order followed by id
+    return db.session.query(*[getattr(BashHistory, name) for name in HISTORY_COLUMNS], BashHistory.id)\
+        .filter(BashHistory.scenario_name == sName).filter(BashHistory.player == player)
+
+
+def historyFirstPages(sName, limit=50):
+    """First page of every player's log from one windowed query.
+
+    Returns ({player: csv style lists}, {player: cursor of the next page or None}), pages continue
+    with dashboard.playerLogs.
+    """
+    rank = func.row_number().over(partition_by=BashHistory.player,
+                                  order_by=(BashHistory.timestamp, BashHistory.id)).label("rank")
+    ranked = db.session.query(*[getattr(BashHistory, name) for name in HISTORY_COLUMNS], BashHistory.id, rank)\
+        .filter(BashHistory.scenario_name == sName).subquery()
+    query = db.session.query(ranked).filter(ranked.c.rank <= limit + 1).order_by(ranked.c.player, ranked.c.rank)
+    logs, cursors = {}, {}
+    for r in query:
+        if r.rank > limit:
+            last = logs[r.player][-1]
+            cursors[r.player] = encodeCursor(last.timestamp, last.id)
+            continue
+        logs.setdefault(r.player, []).append(r)
+        cursors.setdefault(r.player, None)
+    pages = {p: [[getattr(r, name) for name in HISTORY_COLUMNS] for r in rows] for p, rows in logs.items()}
+    return pages, cursors
+
+
+def historyDict(row):
+    d = {name: getattr(row, name) for name in HISTORY_COLUMNS}
+    d["timestamp"] = str(d["timestamp"])
+    return d
+
+
+# ---- log downloads
+
+
+def convertedLog(path, start, stop, chunk=64 * 1024):
+    # bytes [start, stop) of a log with tabs turned into commas, which keeps every byte offset the same
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(chunk, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data.replace(b"\t", b",")
+
+
+def gzipped(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip header and trailer
+    for c in chunks:
+        data = z.compress(c)
+        if data:
+            yield data
+    yield z.flush()
+
+
+def attachmentName(fname):
+    # ?user= ends up in file names, werkzeug quotes the rest but a control character would break the header
+    return "".join(c for c in fname if c.isprintable())
+
+
+def ifRangeMatches(etag, lastModified):
+    # whether the request's If-Range (an etag or an http date) still describes the file
+    ifRange = request.if_range
+    if ifRange.etag is not None:
+        return ifRange.etag == etag
+    if ifRange.date is not None:
+        return int(ifRange.date.replace(tzinfo=dt.timezone.utc).timestamp()) == lastModified
+    return True  # no If-Range
+
+
+def logResponse(path, fname):
+    """Stream a scenario log as csv, with Range, ETag / Last-Modified and optional ?gzip=1 support."""
+    st = os.stat(path)
+    compress = request.args.get("gzip") == "1"
+    etag = "{0:x}-{1:x}".format(st.st_mtime_ns, st.st_size) + ("-gz" if compress else "")
+    start, stop = 0, st.st_size
+    status = 200
+    lastModified = int(st.st_mtime)
+    # byte ranges of the gzip stream are not supported, several ranges at once get the whole file
+    ranged = request.range is not None and not compress and len(request.range.ranges) == 1
+    if ranged and not ifRangeMatches(etag, lastModified):
+        ranged = False  # file changed since the client's partial copy, send all of it
+    if ranged:
+        byteRange = request.range.range_for_length(st.st_size)
+        if byteRange is None:
+            response = Response(status=416)
+            response.headers["Content-Range"] = "bytes */{0}".format(st.st_size)
+            return response
+        start, stop = byteRange
+        status = 206
+
+    body = convertedLog(path, start, stop)
+    if compress:
+        body = gzipped(body)
+        fname += ".gz"
+    response = Response(body, status=status, mimetype="application/gzip" if compress else "text/csv",
+                        direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = dt.datetime.utcfromtimestamp(lastModified)
+    response.headers.set("Content-Disposition", "attachment", filename=attachmentName(fname))
+    if not compress:
+        response.accept_ranges = "bytes"
+        response.content_length = stop - start
+    if status == 206:
+        response.headers["Content-Range"] = "bytes {0}-{1}/{2}".format(start, stop - 1, st.st_size)
+    return response.make_conditional(request)  # 304 for If-None-Match / If-Modified-Since
+
+
+def parseTime(value):
+    try:
+        return dt.datetime.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+
+def checkpointOffset(path):
+    return db.session.query(LogCheckpoints.offset).filter(LogCheckpoints.path == path).scalar() or 0
+
+
+def historyResponse(sName, user=None, start=None, end=None):
+    """Stream a scenario's commands as csv, optionally for one player and a time window.
+
+    Commands already in bash_history come from the table, the part of the log not ingested yet is read
+    from the file as it streams, so the export is complete without waiting for ingestHistory.
+    """
+    start = parseTime(start) if start else None
+    end = parseTime(end) if end else None
+    criteria = []
+    if user:
+        criteria.append(BashHistory.player == user)
+    if start:
+        criteria.append(BashHistory.timestamp >= start)
+    if end:
+        criteria.append(BashHistory.timestamp < end)
+    path = historyPath(sName)
+    query = db.session.query(*[getattr(BashHistory, name) for name in HISTORY_COLUMNS])\
+        .filter(BashHistory.scenario_name == sName).filter(*criteria)\
+        .order_by(BashHistory.timestamp, BashHistory.id).yield_per(BATCH_SIZE)
+    for _ in range(3):
+        # an ingest commits rows and offset together: if the offset is the same before and after the query
+        # started, the query saw exactly the records before it
+        offset = checkpointOffset(path)
+        table = iter(query)
+        if checkpointOffset(path) == offset:
+            break
+        table.close()
+
+    def selected(row):
+        return (not user or row["player"] == user) and (start is None or row["timestamp"] >= start) \
+            and (end is None or row["timestamp"] < end)
+
+    def tail():
+        # records past the checkpoint, straight from the log
+        pos = offset
+        with open(path, "rb") as f:
+            while True:
+                length, text = readRecords(f, pos)
+                if length == 0:
+                    return
+                pos += length
+                for fields in csvRecords(text):
+                    row = historyRow(sName, fields) if fields is not None else None
+                    if row is not None and selected(row):
+                        yield [row[name] for name in HISTORY_COLUMNS]
+
+    def rows():
+        buf = io.StringIO()
+        writer = csv.writer(buf, quotechar=QUOTECHAR)
+        for source in (table, tail()):
+            for row in source:
+                writer.writerow(row)
+                if buf.tell() > 64 * 1024:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+        yield buf.getvalue()
+
+    fname = sName + "-history" + ("-" + user if user else "") + ".csv"
+    response = Response(stream_with_context(rows()), mimetype="text/csv")
+    response.headers.set("Content-Disposition", "attachment", filename=attachmentName(fname))
+    return response
@@ -0,0 +1,77 @@
+"""The logged in user's identity and role, resolved once per request."""
+from typing import NamedTuple
+
+from flask import abort, g, has_app_context
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class Identity(NamedTuple):
+    id: int
+    username: str
+    is_admin: bool
+    is_instructor: bool
+    role: str  # 'a', 'a/i', 'i' or 's', as taken by generateNavElements
+
+
+def roleOf(is_admin, is_instructor):
+    if is_admin:
+        return 'a/i' if is_instructor else 'a'
+    return 'i' if is_instructor else 's'
+
+
+def currentIdentity():
+    """Identity of the logged in user, None if nobody is.
+
+    Built from current_user, which flask_login has already loaded for the request, and kept on g,
+    so role checks never query the users table themselves.
+    """
+    if "identity" not in g:
+        if current_user.is_authenticated:
+            g.identity = Identity(current_user.id, current_user.username, bool(current_user.is_admin),
+                                  bool(current_user.is_instructor),
+                                  roleOf(current_user.is_admin, current_user.is_instructor))
+        else:
+            g.identity = None
+    return g.identity
+
+
+def currentRole():
+    identity = currentIdentity()
+    return identity.role if identity is not None else None
+
+
+def requirePrivs():
+    # admins and instructors only
+    identity = currentIdentity()
+    if identity is None or not (identity.is_admin or identity.is_instructor):
+        abort(403)
+    return identity
+
+
+def requireAdmin():
+    identity = currentIdentity()
+    if identity is None or not identity.is_admin:
+        abort(403)
+    return identity
+
+
+def requireInstructor():
+    identity = currentIdentity()
+    if identity is None or not identity.is_instructor:
+        abort(403)
+    return identity
+
+
+# ---- statements per request, e.g. assert queryCount() == 2 after a test client request
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def countQuery(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        g.queryCount = g.get("queryCount", 0) + 1
+
+
+def queryCount():
+    return g.get("queryCount", 0)
@@ -0,0 +1,82 @@
+"""Progress records, answer keys, log checkpoints and lookup indexes
+
+Adds scenario_progress, answer_keys and log_checkpoints, bash_history.player, and the composite indexes
+on responses, group_users and bash_history.
+
+Revision ID: 6a1f0c2d9b3e
+Revises:
+Create Date: 2026-10-17 00:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "6a1f0c2d9b3e"
+# point this at the current head of migrations/versions (flask db heads) before upgrading
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_responses_scenario_user_attempt", "responses",
+                    ["scenario_id", "user_id", "attempt", "response_time"])
+    op.create_index("ix_responses_scenario_user_question", "responses",
+                    ["scenario_id", "user_id", "question", "response_time"])
+    op.create_index("ix_group_users_user_group", "group_users", ["user_id", "group_id"])
+    op.create_index("ix_group_users_group", "group_users", ["group_id"])
+
+    op.create_table(
+        "scenario_progress",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("scenario_id", sa.Integer(), nullable=False),
+        sa.Column("attempt", sa.Integer(), nullable=False),
+        sa.Column("answered", sa.Integer(), nullable=False),
+        sa.Column("points", sa.Integer(), nullable=False),
+        sa.Column("correct", sa.Text(), nullable=False),
+        sa.ForeignKeyConstraint(["scenario_id"], ["scenarios.id"]),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("user_id", "scenario_id", "attempt", name="uq_scenario_progress_user_scenario_attempt"),
+    )
+    op.create_table(
+        "answer_keys",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("scenario_id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("template", sa.String(length=80), nullable=False),
+        sa.Column("answer", sa.String(length=80), nullable=True),
+        sa.ForeignKeyConstraint(["scenario_id"], ["scenarios.id"]),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("scenario_id", "user_id", "template", name="uq_answer_keys_scenario_user_template"),
+    )
+    op.create_table(
+        "log_checkpoints",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("path", sa.String(length=200), nullable=False),
+        sa.Column("offset", sa.BigInteger(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("path"),
+    )
+
+    op.add_column("bash_history", sa.Column("player", sa.String(length=40), nullable=True))
+    op.create_index("ix_bash_history_scenario_player_time", "bash_history",
+                    ["scenario_name", "player", "timestamp", "id"])
+
+
+def downgrade():
+    op.drop_index("ix_bash_history_scenario_player_time", table_name="bash_history")
+    with op.batch_alter_table("bash_history") as batch_op:  # sqlite can't drop columns in place
+        batch_op.drop_column("player")
+
+    op.drop_table("log_checkpoints")
+    op.drop_table("answer_keys")
+    op.drop_table("scenario_progress")
+
+    op.drop_index("ix_group_users_group", table_name="group_users")
+    op.drop_index("ix_group_users_user_group", table_name="group_users")
+    op.drop_index("ix_responses_scenario_user_question", table_name="responses")
+    op.drop_index("ix_responses_scenario_user_attempt", table_name="responses")
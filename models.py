@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """User models."""
 import datetime as dt
-import random
+import secrets
 import string
 
 from flask_login import UserMixin
@@ -21,7 +21,7 @@ from edurange_refactored.extensions import bcrypt
 
 
 def generate_registration_code(size=8, chars=string.ascii_lowercase + string.digits):
-    return "".join(random.choice(chars) for _ in range(size))
+    return "".join(secrets.choice(chars) for _ in range(size))
 
 
 class StudentGroups(UserMixin, SurrogatePK, Model):
@@ -32,8 +32,8 @@ class StudentGroups(UserMixin, SurrogatePK, Model):
     owner_id = reference_col("users", nullable=False)
     owner = relationship("User", backref="groups")
     code = Column(
-        db.String(8), unique=True, nullable=True, default=generate_registration_code()
-    )
+        db.String(8), unique=True, nullable=True, default=generate_registration_code
+    )  # bulk creation takes codes from provision_utils.codePool
     hidden = Column(db.Boolean(), nullable=False, default=False)
     users = relationship("GroupUsers", backref="groups", cascade="all, delete-orphan")
 
@@ -42,6 +42,10 @@ class GroupUsers(UserMixin, SurrogatePK, Model):
     """Users belong to groups"""
 
     ___tablename___ = "group_users"
+    __table_args__ = (
+        db.Index("ix_group_users_user_group", "user_id", "group_id"),  # membership checks
+        db.Index("ix_group_users_group", "group_id"),  # members of a group
+    )
     user_id = reference_col("users", nullable=False)
     user = relationship("User", backref="group_users")
     group_id = reference_col("groups", nullable=False)
@@ -91,7 +95,7 @@ class Scenarios(UserMixin, SurrogatePK, Model):
     name = Column(db.String(40), unique=False, nullable=False)
     description = Column(db.String(80), unique=False, nullable=True)
     owner_id = reference_col("users", nullable=False)
-    owner = relationship("User", backref="scenarios", lazy="subquery")
+    owner = relationship("User", backref="scenarios")
     created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
     status = Column(db.Integer, default=0, nullable=False)
     attempt = Column(db.Integer, default=0, nullable=False, server_default="0")
@@ -119,6 +123,12 @@ class Responses(UserMixin, SurrogatePK, Model):
     """Student responses to scenario questions"""
 
     __tablename__ = "responses"
+    __table_args__ = (
+        # progress and scoring of an attempt
+        db.Index("ix_responses_scenario_user_attempt", "scenario_id", "user_id", "attempt", "response_time"),
+        # most recent answer to a question
+        db.Index("ix_responses_scenario_user_question", "scenario_id", "user_id", "question", "response_time"),
+    )
     user_id = reference_col("users", nullable=False)
     user = relationship("User", backref="responses")
     scenario_id = reference_col("scenarios", nullable=False)
@@ -132,10 +142,43 @@ class Responses(UserMixin, SurrogatePK, Model):
     # learning objective field?
 
 
+class ScenarioProgress(UserMixin, SurrogatePK, Model):
+    """Running score of a user's scenario attempt, updated as responses are inserted"""
+
+    __tablename__ = "scenario_progress"
+    __table_args__ = (db.UniqueConstraint("user_id", "scenario_id", "attempt", name="uq_scenario_progress_user_scenario_attempt"),)
+
+    user_id = reference_col("users", nullable=False)
+    scenario_id = reference_col("scenarios", nullable=False)
+    scenario = relationship("Scenarios", backref=db.backref("progress", cascade="all, delete-orphan"))
+    attempt = Column(db.Integer, default=0, nullable=False)
+    answered = Column(db.Integer, default=0, nullable=False)  # questions with a correct answer
+    points = Column(db.Integer, default=0, nullable=False)
+    correct = Column(db.Text, default="0", nullable=False)  # hex bitmap of scored answers, see QuestionSet.record
+
+
+class AnswerKeys(UserMixin, SurrogatePK, Model):
+    """Templated answers (${player.login}, ${scenario.instances...}) resolved for each player"""
+
+    __tablename__ = "answer_keys"
+    # one answer per template and player, also the (scenario_id, user_id) lookup index
+    __table_args__ = (db.UniqueConstraint("scenario_id", "user_id", "template", name="uq_answer_keys_scenario_user_template"),)
+
+    scenario_id = reference_col("scenarios", nullable=False)
+    scenario = relationship("Scenarios", backref=db.backref("answer_keys", cascade="all, delete-orphan"))
+    user_id = reference_col("users", nullable=False)
+    template = Column(db.String(80), nullable=False)  # answer as written in questions.yml
+    answer = Column(db.String(80), nullable=True)
+
+
 class BashHistory(UserMixin, SurrogatePK, Model):
     """Bash Histories, associated with users and scenarios"""
 
     __tablename__ = "bash_history"
+    __table_args__ = (
+        # a player's log in order, see history_utils.playerHistory
+        db.Index("ix_bash_history_scenario_player_time", "scenario_name", "player", "timestamp", "id"),
+    )
 
     scenario_name = Column(db.String(40), unique=False, nullable=False)
     container_name = Column(db.String(40), nullable=False, unique=False)
@@ -144,4 +187,15 @@ class BashHistory(UserMixin, SurrogatePK, Model):
     input = Column(db.String(250), nullable=False, unique=False)
     output = Column(db.String(10000), nullable=False, unique=False)
     prompt = Column(db.String(80), nullable=False, unique=False)
+    player = Column(db.String(40), nullable=True, unique=False)  # username the command was run as
+
+
+class LogCheckpoints(UserMixin, SurrogatePK, Model):
+    """How far a scenario log file has been copied into the database"""
+
+    __tablename__ = "log_checkpoints"
+
+    path = Column(db.String(200), unique=True, nullable=False)
+    offset = Column(db.BigInteger, default=0, nullable=False)  # bytes of the file already ingested
+    updated_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
 
@@ -0,0 +1,67 @@
+"""Keyset pagination for the dashboard's JSON list endpoints."""
+import base64
+import json
+from datetime import datetime
+
+from flask import abort, request
+from sqlalchemy import and_, or_
+
+MAX_LIMIT = 500
+
+
+def encodeCursor(value, key):
+    # last row's (sort value, key) -> opaque url safe string
+    if isinstance(value, datetime):
+        value = {"dt": value.isoformat()}
+    return base64.urlsafe_b64encode(json.dumps([value, key]).encode()).decode()
+
+
+def decodeCursor(cursor):
+    try:
+        value, key = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if isinstance(value, dict):
+            value = datetime.fromisoformat(value["dt"])
+        return value, key
+    except (ValueError, TypeError, KeyError):
+        abort(400)
+
+
+def keysetPage(query, sorts, key, default, order="desc", search=None, limit=50):
+    """One page of query, sorted and filtered from the request's arguments.
+
+    sorts maps the names accepted in ?sort= to sortable expressions, key is a unique column used to break ties.
+    ?order=asc|desc picks the direction (order by default), ?after= is the cursor returned with the previous page,
+    ?limit= the page size and ?q= a case insensitive filter applied to the search expression.
+    Returns (rows, cursor of the next page or None).
+    """
+    sort = request.args.get("sort", default)
+    if sort not in sorts:
+        abort(400)
+    column = sorts[sort]
+    desc = request.args.get("order", order) == "desc"
+    limit = max(1, min(request.args.get("limit", limit, type=int), MAX_LIMIT))
+
+    q = request.args.get("q")
+    if q and search is not None:
+        pattern = "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        query = query.filter(search.ilike(pattern, escape="\\"))
+
+    after = request.args.get("after")
+    if after:
+        value, last = decodeCursor(after)
+        if desc:
+            query = query.filter(or_(column < value, and_(column == value, key < last)))
+        else:
+            query = query.filter(or_(column > value, and_(column == value, key > last)))
+
+    if desc:
+        query = query.order_by(column.desc(), key.desc())
+    else:
+        query = query.order_by(column.asc(), key.asc())
+    rows = query.add_columns(column.label("sort_value"), key.label("sort_key")).limit(limit + 1).all()
+
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = encodeCursor(rows[-1].sort_value, rows[-1].sort_key)
+    return rows, cursor
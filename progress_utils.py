@@ -0,0 +1,100 @@
+"""Per-attempt scenario progress, kept up to date as responses are inserted."""
+from sqlalchemy import and_, event, select
+from sqlalchemy.exc import IntegrityError
+
+from edurange_refactored.extensions import db
+
+from .grading_utils import scenarioQuestions
+from .user.models import AnswerKeys, Responses, ScenarioProgress, Scenarios
+
+progress = ScenarioProgress.__table__
+responses = Responses.__table__
+scenarios = Scenarios.__table__
+answerKeys = AnswerKeys.__table__
+
+
+def attemptResponses(conn, uid, sid, att):
+    # every response of an attempt, oldest first
+    return conn.execute(
+        select([responses.c.question, responses.c.student_response, responses.c.points])
+        .where(and_(responses.c.user_id == uid, responses.c.scenario_id == sid, responses.c.attempt == att))
+        .order_by(responses.c.response_time, responses.c.id)
+    ).fetchall()
+
+
+def keyResolver(conn, uid, sid):
+    # resolve(template) from the player's stored answer key, read once when a templated answer needs it
+    keys = []
+
+    def resolve(template):
+        if not keys:
+            keys.append(dict(conn.execute(
+                select([answerKeys.c.template, answerKeys.c.answer])
+                .where(and_(answerKeys.c.scenario_id == sid, answerKeys.c.user_id == uid))
+            ).fetchall()))
+        return keys[0].get(template)
+
+    return resolve
+
+
+def tallyProgress(questions, rows, resolve=None):
+    # (bitmap, points, questions answered) from a list of responses
+    mask = earned = answered = 0
+    for r in rows:
+        mask, pts, new = questions.record(mask, r.question, r.student_response, r.points, resolve)
+        earned += pts
+        answered += new
+    return mask, earned, answered
+
+
+def progressWhere(uid, sid, att):
+    return and_(progress.c.user_id == uid, progress.c.scenario_id == sid, progress.c.attempt == att)
+
+
+def lockProgress(conn, uid, sid, att):
+    return conn.execute(
+        select([progress.c.id, progress.c.answered, progress.c.points, progress.c.correct])
+        .where(progressWhere(uid, sid, att)).with_for_update()
+    ).first()
+
+
+@event.listens_for(Responses, "after_insert")
+def recordResponse(mapper, connection, target):
+    # runs inside the flush that inserts the response, so the record commits or rolls back with it
+    uid, sid, att = target.user_id, target.scenario_id, target.attempt or 0
+    name, s_type = connection.execute(select([scenarios.c.name, scenarios.c.description])
+                                      .where(scenarios.c.id == sid)).first()
+    try:
+        questions = scenarioQuestions(name, s_type)
+    except FileNotFoundError:
+        return  # nothing to grade against, attemptProgress falls back to the responses
+    resolve = keyResolver(connection, uid, sid)
+    row = lockProgress(connection, uid, sid, att)
+    if row is None:
+        # first response of the attempt, or responses from before the record existed
+        mask, earned, answered = tallyProgress(questions, attemptResponses(connection, uid, sid, att), resolve)
+        try:
+            with connection.begin_nested():
+                connection.execute(progress.insert().values(user_id=uid, scenario_id=sid, attempt=att, answered=answered,
+                                                            points=earned, correct=format(mask, 'x')))
+            return
+        except IntegrityError:  # created by a concurrent answer, add this one to it
+            row = lockProgress(connection, uid, sid, att)
+    mask, pts, new = questions.record(int(row.correct, 16), target.question, target.student_response,
+                                      target.points or 0, resolve)
+    if pts:
+        connection.execute(progress.update().where(progress.c.id == row.id)
+                           .values(answered=row.answered + new, points=row.points + pts, correct=format(mask, 'x')))
+
+
+def attemptProgress(uid, sid, att, questions):
+    """(questions answered, points earned) for one attempt."""
+    record = db.session.query(ScenarioProgress.answered, ScenarioProgress.points)\
+        .filter(ScenarioProgress.user_id == uid).filter(ScenarioProgress.scenario_id == sid)\
+        .filter(ScenarioProgress.attempt == att).first()
+    if record is not None:
+        return record.answered, record.points
+    # nothing recorded yet, the record is created with the next response
+    mask, earned, answered = tallyProgress(questions, attemptResponses(db.session, uid, sid, att),
+                                           keyResolver(db.session, uid, sid))
+    return answered, earned
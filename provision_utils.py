@@ -0,0 +1,136 @@
+"""Bulk creation of groups and their users."""
+import hashlib
+import os
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import bcrypt
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from edurange_refactored.extensions import db
+
+from .user.models import GroupUsers, StudentGroups, User, generate_registration_code
+
+HASH_CHUNK = 8  # passwords hashed per worker task
+GENERATED_EMAIL_DOMAIN = "edurange.org"  # generated users get <username>@<domain>
+
+
+class RegistrationCodePool:
+    """Registration codes reserved ahead of time for new groups.
+
+    Codes are drawn in batches and checked against StudentGroups.code with a few queries per batch,
+    so handing out thousands of codes does not cost a round-trip (or a retry) per group.
+    """
+
+    def __init__(self, batch=1000, chunk=500):
+        self.batch = batch
+        self.chunk = chunk  # codes per IN (...) check
+        self.issued = 0
+        self.refills = 0
+        self.collisions = 0
+        self._codes = []
+        self._lock = threading.Lock()
+
+    def refill(self, n):
+        candidates = set()
+        while len(candidates) < n:
+            candidates.add(generate_registration_code())
+        candidates = list(candidates)
+        for i in range(0, len(candidates), self.chunk):
+            part = candidates[i:i + self.chunk]
+            used = {c for c, in db.session.query(StudentGroups.code).filter(StudentGroups.code.in_(part))}
+            self.collisions += len(used)
+            self._codes.extend(c for c in part if c not in used)
+        self.refills += 1
+
+    def take(self, n=1):
+        # n unused codes
+        with self._lock:
+            while len(self._codes) < n:
+                self.refill(max(n - len(self._codes), self.batch))
+            codes = self._codes[-n:]
+            del self._codes[-n:]
+            self.issued += n
+        return codes
+
+    def stats(self):
+        with self._lock:
+            return {'reserved': len(self._codes), 'issued': self.issued, 'refills': self.refills,
+                    'collisions': self.collisions, 'batch': self.batch}
+
+
+codePool = RegistrationCodePool()
+
+
+def hashPasswords(passwords, rounds, prehash=False):
+    # same hashes as flask_bcrypt's generate_password_hash, runs in a worker process
+    hashed = []
+    for p in passwords:
+        p = p.encode("utf-8")
+        if prehash:  # BCRYPT_HANDLE_LONG_PASSWORDS
+            p = hashlib.sha256(p).hexdigest().encode("utf-8")
+        hashed.append(bcrypt.hashpw(p, bcrypt.gensalt(rounds)))
+    return hashed
+
+
+def generatedUsers(name, size):
+    # (username, password) pairs for a generated group: <group name><n> with a random password
+    base = "".join(e for e in name if e.isalnum()).lower()
+    width = len(str(size))
+    return [(base + str(n).zfill(width), secrets.token_urlsafe(9)) for n in range(1, size + 1)]
+
+
+def provisionGroup(name, owner_id, users, static=True):
+    """Create a group and its members in bulk, yielding progress as dicts.
+
+    users is a list of (username, password). Passwords are hashed in parallel on a process pool, then the users,
+    the group and its memberships are inserted with one executemany each.
+    Yields {'stage': 'hashing', 'done', 'total'} while hashing, then {'stage': 'done', 'group', 'code', 'users'}
+    or {'stage': 'error', 'message'}.
+    """
+    db_ses = db.session
+    names = [u for u, p in users]
+    if db_ses.query(StudentGroups.id).filter(StudentGroups.name == name).first() is not None:
+        yield {'stage': 'error', 'message': "Group {0} already exists".format(name)}
+        return
+    taken = [u for u, in db_ses.query(User.username).filter(User.username.in_(names))]
+    if taken:
+        yield {'stage': 'error', 'message': "Usernames already taken: " + ", ".join(taken)}
+        return
+
+    rounds = current_app.config.get("BCRYPT_LOG_ROUNDS", 12)
+    prehash = current_app.config.get("BCRYPT_HANDLE_LONG_PASSWORDS", False)
+    chunks = [users[i:i + HASH_CHUNK] for i in range(0, len(users), HASH_CHUNK)]
+    hashes = {}
+    done = 0
+    yield {'stage': 'hashing', 'done': 0, 'total': len(users)}
+    with ProcessPoolExecutor(max_workers=min(len(chunks), os.cpu_count() or 1) or 1) as pool:
+        futures = {pool.submit(hashPasswords, [p for u, p in chunk], rounds, prehash): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            chunk = futures[future]
+            for (username, password), hashed in zip(chunk, future.result()):
+                hashes[username] = hashed
+            done += len(chunk)
+            yield {'stage': 'hashing', 'done': done, 'total': len(users)}
+
+    try:
+        group = StudentGroups(name=name, owner_id=owner_id, code=codePool.take()[0])
+        db_ses.add(group)
+        db_ses.flush()
+        if users:
+            db_ses.execute(User.__table__.insert(), [
+                {'username': u, 'email': u + "@" + GENERATED_EMAIL_DOMAIN, 'password': hashes[u], 'is_static': static}
+                for u in names
+            ])
+            uids = [uid for uid, in db_ses.query(User.id).filter(User.username.in_(names))]
+            db_ses.execute(GroupUsers.__table__.insert(), [{'user_id': uid, 'group_id': group.id} for uid in uids])
+        db_ses.commit()
+    except IntegrityError:
+        # the group or a username was taken while hashing, the response has already started so report it here
+        db_ses.rollback()
+        yield {'stage': 'error', 'message': "Group {0} or one of its usernames was created meanwhile".format(name)}
+        return
+    yield {'stage': 'done', 'group': name, 'code': group.code,
+           'users': [{'username': u, 'password': p} for u, p in users]}
@@ -0,0 +1,170 @@
+"""Scenario status changes pushed to the dashboard, and lifecycle actions on many scenarios at once."""
+import json
+import queue
+import threading
+import time
+
+from celery import group
+from flask import current_app
+
+from edurange_refactored.extensions import db
+
+from .tasks import DestroyScenarioTask, StartScenarioTask, StopScenarioTask
+from .user.models import Scenarios
+
+POLL_INTERVAL = 1.0  # seconds between status checks of the shared poller
+STREAM_SECONDS = 300  # a stream ends after this long, EventSource reconnects on its own
+HEARTBEAT_SECONDS = 15  # comment line sent when nothing changed, keeps proxies from closing the stream
+QUEUE_SIZE = 1000  # events a slow stream may fall behind by, it gets a fresh snapshot when it reconnects
+
+# action -> (task, statuses it may start from, status set before the task runs or None)
+ACTIONS = {
+    "start": (StartScenarioTask, (0,), 3),
+    "stop": (StopScenarioTask, (1,), 4),
+    "destroy": (DestroyScenarioTask, (0,), None),
+}
+
+
+def scenarioStatuses():
+    # {scenario id: status}, ends the transaction so the next call sees newer commits
+    statuses = dict(db.session.query(Scenarios.id, Scenarios.status))
+    db.session.rollback()
+    return statuses
+
+
+def sseEvent(event, data):
+    return "event: {0}\ndata: {1}\n\n".format(event, json.dumps(data))
+
+
+class StatusFeed:
+    """Scenario status changes of a process, fanned out to every open stream.
+
+    One thread checks the statuses every interval seconds while any stream is subscribed, however many
+    dashboards are open, and stops when the last one leaves. bulkLifecycle publishes the statuses it
+    sets itself, so those show up at once.
+    """
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self.known = None  # {id: status} as of the last check
+        self._subscribers = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, app):
+        q = queue.Queue(maxsize=QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(q)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, args=(app,), name="scenario-status", daemon=True)
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers)
+            if event == "status" and self.known is not None:
+                self.known[data["id"]] = data["status"]  # the poller doesn't send it again
+        for q in subscribers:
+            try:
+                q.put_nowait((event, data))
+            except queue.Full:
+                pass
+
+    def changes(self, current):
+        with self._lock:
+            known, self.known = self.known, current
+        if known is None:
+            return
+        for sid, status in current.items():
+            if sid not in known:
+                yield "created", {"id": sid, "status": status}
+            elif known[sid] != status:
+                yield "status", {"id": sid, "status": status}
+        for sid in known.keys() - current.keys():
+            yield "removed", {"id": sid}
+
+    def run(self, app):
+        with app.app_context():
+            while True:
+                with self._lock:
+                    if not self._subscribers:
+                        self._thread = None
+                        self.known = None
+                        return
+                try:
+                    for event, data in list(self.changes(scenarioStatuses())):
+                        self.publish(event, data)
+                except Exception:  # keep polling, e.g. through a database restart
+                    app.logger.exception("scenario status check failed")
+                finally:
+                    db.session.remove()
+                time.sleep(self.interval)
+
+
+statusFeed = StatusFeed()
+
+
+def statusEvents(duration=STREAM_SECONDS):
+    """Server-sent events for status transitions of scenarios.
+
+    Sends every status once as 'snapshot', then a 'status' event {id, status} for each change,
+    'created' / 'removed' {id} when scenarios appear or are destroyed, as published by statusFeed.
+    Each open stream holds its worker until it ends, so the app has to run on threaded or async
+    workers (e.g. gunicorn --threads or gevent) for the dashboard to stay usable.
+    """
+    q = statusFeed.subscribe(current_app._get_current_object())
+    try:
+        yield "retry: 3000\n\n"
+        yield sseEvent("snapshot", scenarioStatuses())
+        stop = time.monotonic() + duration
+        while True:
+            remaining = stop - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                event, data = q.get(timeout=min(HEARTBEAT_SECONDS, remaining))
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield sseEvent(event, data)
+    finally:
+        statusFeed.unsubscribe(q)
+
+
+def bulkLifecycle(action, ids, owner_id=None):
+    """Run a start / stop / destroy task for each scenario in ids, in parallel on the workers.
+
+    Only scenarios in a status the action may start from (and owned by owner_id, if given) are sent,
+    their status is set to the transitional one first so the dashboard shows it at once.
+    Returns {'queued': [ids], 'skipped': {id: reason}}.
+    """
+    task, allowed, pending = ACTIONS[action]
+    db_ses = db.session
+    query = db_ses.query(Scenarios.id, Scenarios.status, Scenarios.owner_id).filter(Scenarios.id.in_(ids))
+    rows = {r.id: r for r in query.with_for_update()}
+    queued, skipped = [], {}
+    for sid in ids:
+        r = rows.get(sid)
+        if r is None:
+            skipped[sid] = "not found"
+        elif owner_id is not None and str(r.owner_id) != str(owner_id):
+            skipped[sid] = "not owner"
+        elif r.status not in allowed:
+            skipped[sid] = "status {0}".format(r.status)
+        elif sid not in queued:
+            queued.append(sid)
+    if queued and pending is not None:
+        db_ses.query(Scenarios).filter(Scenarios.id.in_(queued))\
+            .update({Scenarios.status: pending}, synchronize_session=False)
+    db_ses.commit()  # statuses are visible before the workers pick the tasks up
+    if queued and pending is not None:
+        for sid in queued:
+            statusFeed.publish("status", {"id": sid, "status": pending})
+    if queued:
+        group(task.s(sid) for sid in queued).apply_async()
+    return {"queued": queued, "skipped": skipped}
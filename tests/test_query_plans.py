@@ -0,0 +1,94 @@
+"""Query plans of the hot response, membership and history lookups.
+
+Runs against an in-memory SQLite database seeded with ROWS responses (QUERY_PLAN_ROWS, 1M for the
+full-size check) and ANALYZEd, and asserts each lookup is answered from its composite index with no
+separate sort.
+"""
+import datetime as dt
+import os
+
+import pytest
+from sqlalchemy import and_, create_engine, select, text
+
+from edurange_refactored.extensions import db
+from edurange_refactored.user.models import BashHistory, GroupUsers, Responses
+
+ROWS = int(os.environ.get("QUERY_PLAN_ROWS", 20000))
+SCENARIOS = 20
+USERS = 100
+QUESTIONS = 10
+
+responses = Responses.__table__
+groupUsers = GroupUsers.__table__
+history = BashHistory.__table__
+
+
+@pytest.fixture(scope="module")
+def engine():
+    engine = create_engine("sqlite://")
+    db.metadata.create_all(engine, tables=[responses, groupUsers, history])
+    start = dt.datetime(2020, 1, 1)
+    with engine.begin() as conn:
+        batch = []
+        for i in range(ROWS):
+            batch.append({"user_id": i % USERS + 1, "scenario_id": i // USERS % SCENARIOS + 1,
+                          "question": i % QUESTIONS + 1, "student_response": str(i), "points": i % 2,
+                          "response_time": start + dt.timedelta(seconds=i), "attempt": i % 3})
+            if len(batch) == 10000:
+                conn.execute(responses.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(responses.insert(), batch)
+        conn.execute(groupUsers.insert(), [{"user_id": u, "group_id": u % 10 + 1} for u in range(1, USERS + 1)])
+        conn.execute(history.insert(), [
+            {"scenario_name": "s{0}".format(i % SCENARIOS), "container_name": "c", "timestamp": start + dt.timedelta(seconds=i),
+             "current_directory": "/", "input": "ls", "output": "", "prompt": "$", "player": "p{0}".format(i % USERS)}
+            for i in range(ROWS // 10)
+        ])
+        conn.execute(text("ANALYZE"))
+    return engine
+
+
+def plan(engine, statement):
+    sql = str(statement.compile(engine, compile_kwargs={"literal_binds": True}))
+    with engine.connect() as conn:
+        return " | ".join(row[-1] for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql)))
+
+
+def assertIndexScan(engine, statement, index):
+    detail = plan(engine, statement)
+    assert "INDEX " + index in detail, detail
+    assert "TEMP B-TREE" not in detail, detail  # the index order is used, no sort
+
+
+def test_attempt_responses_use_index(engine):
+    # progress_utils.attemptResponses
+    statement = select([responses.c.question, responses.c.student_response, responses.c.points])\
+        .where(and_(responses.c.user_id == 7, responses.c.scenario_id == 3, responses.c.attempt == 1))\
+        .order_by(responses.c.response_time, responses.c.id)
+    assertIndexScan(engine, statement, "ix_responses_scenario_user_attempt")
+
+
+def test_latest_answer_uses_index(engine):
+    # most recent response to a question, utils.latestPoints
+    statement = select([responses.c.points])\
+        .where(and_(responses.c.scenario_id == 3, responses.c.user_id == 7, responses.c.question == 2))\
+        .order_by(responses.c.response_time.desc()).limit(1)
+    assertIndexScan(engine, statement, "ix_responses_scenario_user_question")
+
+
+def test_membership_uses_index(engine):
+    statement = select([groupUsers.c.id]).where(and_(groupUsers.c.user_id == 7, groupUsers.c.group_id == 8))
+    assertIndexScan(engine, statement, "ix_group_users_user_group")
+
+
+def test_group_members_use_index(engine):
+    statement = select([groupUsers.c.user_id]).where(groupUsers.c.group_id == 8)
+    assertIndexScan(engine, statement, "ix_group_users_group")
+
+
+def test_player_history_uses_index(engine):
+    # history_utils.playerHistory, ordered like playerLogs pages
+    statement = select([history.c.input]).where(and_(history.c.scenario_name == "s3", history.c.player == "p3"))\
+        .order_by(history.c.timestamp, history.c.id)
+    assertIndexScan(engine, statement, "ix_bash_history_scenario_player_time")
@@ -1,18 +1,27 @@
 """Helper utilities and decorators."""
 import json
 import os
+from datetime import datetime
+from typing import NamedTuple, Optional
 
 import yaml
 import markdown as md
-import ast
-from flask import abort, flash, request, url_for
-from flask_login import current_user
+from flask import abort, current_app, flash, g, request, session, url_for
 from jwt.jwk import OctetJWK, jwk_from_dict
 from markupsafe import Markup
+from sqlalchemy import and_, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
 
 from edurange_refactored.extensions import db
 
-from .user.models import Scenarios, User, Responses
+from .cache_utils import DirectoryIndex, FileCache, VersionedCache
+from .graph_utils import getGraph
+from .history_utils import historyPath
+from .identity_utils import currentIdentity, currentRole
+from .grading_utils import compileQuestions, gradeAttempts, questionSet, scenarioAnswers, scenarioQuestions
+from .progress_utils import attemptProgress
+from .user.models import AnswerKeys, GroupUsers, Responses, ScenarioGroups, Scenarios, StudentGroups, User
 
 path_to_key = os.path.dirname(os.path.abspath(__file__))
 
@@ -46,9 +55,8 @@ def flash_errors(form, category="warning"):
 
 
 def check_role_view(mode):  # check if view mode compatible with role (admin/inst/student)
-    number = current_user.id
-    user = User.query.filter_by(id=number).first()
-    if not user.is_admin and not user.is_instructor:
+    user = currentIdentity()
+    if user is None or (not user.is_admin and not user.is_instructor):
         abort(403)  # student's don't need their role checked
         return None  # a student has no applicable role. does abort stop the calling/parent function?
     else:
@@ -74,7 +82,32 @@ def check_role_view(mode):  # check if view mode compatible with role (admin/ins
 
 # --------
 
+navCache = VersionedCache(maxsize=64)
+NAV_ROLES = ('a', 'a/i', 'i', 's')
+NAV_VIEWS = (None, 'adminView', 'instructorView', 'studentView')
+
+
 def generateNavElements(role, view): # generate all navigational elements
+    """Navigational elements for a role and view, built once per process.
+
+    The markup only changes with the urls url_for produces, so entries are versioned by the app's url map
+    and the request's script root.
+    """
+    if role is None: # user not logged in
+        return {'views': None, 'links': None}
+    version = (id(current_app.url_map), request.script_root)
+    return navCache.lookup((role, view), version, lambda stale: buildNavElements(role, view))
+
+
+def warmNav(app):
+    # build every (role, view) combination, e.g. when the dashboard blueprint is registered
+    with app.test_request_context():
+        for role in NAV_ROLES:
+            for view in NAV_VIEWS:
+                generateNavElements(role, view)
+
+
+def buildNavElements(role, view):
     """Makes decisions and calls correct generators for navigational links based on role."""
     views = None
     links = None
@@ -101,6 +134,11 @@ def generateNavElements(role, view): # generate all navigational elements
                                             # links: redirecting links, to render in sidebar
 
 
+def navElements():
+    """generateNavElements for the logged in user's role and the view picked with dashboard.set_view."""
+    return generateNavElements(currentRole(), session.get("viewMode"))
+
+
 def create_link(route, icon, text):
     """Create html element for a sidebar link (requires route, icon class (font-awesome), and text to label link)."""
     html = '''<a class="list-group-item list-group-item-action bg-secondary text-white" href="{0}">
@@ -169,9 +207,8 @@ def genStudentLinks(view=None): # needs common arg for switch statement
 
 
 def checkAuth(d):
-    number = current_user.id
-    user = User.query.filter_by(id=number).first()
-    if not user.is_instructor and not user.is_admin:
+    user = currentIdentity()
+    if user is None or (not user.is_instructor and not user.is_admin):
         return False
     else:
         return True
@@ -197,32 +234,33 @@ def statReader(s):
     return statSwitch[s]
 
 
-def getDesc(t):
+def loadYaml(path):
+    with open(path, "r") as yml:
+        return yaml.full_load(yml)
+
+
+# parsed scenario yml files, shared by every request handled by this process
+# documents returned from here are shared between callers, do not modify them
+yamlCache = FileCache(loadYaml, maxsize=256)
+
+
+def scenarioFile(t):
+    # ./scenarios/prod/<type>/<type>.yml
     t = t.lower().replace(" ", "_")
-    with open(
-            "./scenarios/prod/" + t + "/" + t + ".yml", "r"
-    ) as yml:  # edurange_refactored/scenarios/prod
-        document = yaml.full_load(yml)
-        for item, doc in document.items():
-            if item == "Description":
-                d = doc
-    return d
+    return "./scenarios/prod/" + t + "/" + t + ".yml"  # edurange_refactored/scenarios/prod
+
+
+def scenarioDefinition(t):
+    return yamlCache.get(scenarioFile(t))
+
+
+def getDesc(t):
+    return scenarioDefinition(t)["Description"]
 
 
 def getGuide2(t):
     # g = "No Codelab for this Scenario"
-    t = t.lower().replace(" ", "_")
-    with open(
-            "./scenarios/prod/" + t + "/" + t + ".yml", "r"
-    ) as yml:  # edurange_refactored/scenarios/prod
-        document = yaml.full_load(yml)
-        for item, doc in document.items():
-            if item == "Codelab":
-                g = doc
-                # print(g)
-                # return g
-    # g = "No Codelab for this Scenario"
-    return g
+    return scenarioDefinition(t)["Codelab"]
 
 
 #
@@ -238,6 +276,11 @@ def getGuide2(t):
 def getGuide(t):
     t = t.title().replace(" ", "_")
     f = "./edurange_refactored/templates/tutorials/" + t + "/" + t + ".md"
+    return guideCache.get(f)
+
+
+def renderGuide(f):
+    # md file -> accordion html
     lines = guideHelp1(f)
     htL = guideHelp2(lines)
     sections = []
@@ -251,6 +294,30 @@ def getGuide(t):
     return guide
 
 
+def loadGuide(f):
+    # if GUIDE_CACHE_DIR is set, rendered guides are also kept there as html named after the md file's mtime,
+    # so they survive restarts and are shared between workers
+    cacheDir = os.getenv("GUIDE_CACHE_DIR")
+    if not cacheDir:
+        return renderGuide(f)
+    name = os.path.splitext(os.path.basename(f))[0]
+    html = os.path.join(cacheDir, name + "." + str(os.stat(f).st_mtime_ns) + ".html")
+    if os.path.isfile(html):
+        with open(html, mode="r", encoding="utf-8") as file:
+            return file.read()
+    guide = renderGuide(f)
+    os.makedirs(cacheDir, exist_ok=True)
+    tmp = html + "." + str(os.getpid())
+    with open(tmp, mode="w", encoding="utf-8") as file:
+        file.write(guide)
+    os.replace(tmp, html)  # other workers never see a partial file
+    return guide
+
+
+# rendered guides, keyed by md path and re-rendered when the md file changes
+guideCache = FileCache(loadGuide, maxsize=64)
+
+
 def guideHelp1(f):
     # reads a md file into a list of lists divided by ---
     lines = []
@@ -271,6 +338,7 @@ def guideHelp1(f):
 
 def guideHelp2(ls):
     # reads a list of lists of md and converts it to a list of lists of html
+    # every line is converted on its own, guideCache keeps the result until the guide changes
     new = []
     tmp = []
     for section in ls:
@@ -345,8 +413,8 @@ def guideHelp4(sec, num):
 
 <hr>
 """)
-    card = card.replace('[SECTION_HEADER]', head).replace('[SECTION_CONTENT]', content)
     card = card.replace('[HEADER_ID]', h_id).replace('[BODY_ID]', b_id)
+    card = card.replace('[SECTION_HEADER]', head).replace('[SECTION_CONTENT]', content)
     return card
 
 
@@ -360,13 +428,11 @@ def guideHelp5(sections):
 </div>
 """)
     titleSec = '' + sections[0][0] + sections[0][1] + "<hr>"
-    guide += titleSec + accOpen
-    sections = sections[1:]
-    num = 0
-    for sec in sections:
-        guide = guide + guideHelp4(sec, num)
-        num += 1
-    guide += accClose
+    parts = [titleSec, accOpen]
+    for num, sec in enumerate(sections[1:]):
+        parts.append(guideHelp4(sec, num))
+    parts.append(accClose)
+    guide += ''.join(parts)
     return guide
 
 
@@ -398,42 +464,55 @@ def guideHelp6(sec, num):
     </div>
 </div>
 """)
+    parts = []
     if h3 not in sec[0]:
-        content += sec[0]
+        parts.append(sec[0])
         sec = sec[1:]
-    content += secAccOpen.replace('[SEC_ACC]', secAcc)
+    parts.append(secAccOpen.replace('[SEC_ACC]', secAcc))
     for i in range(0, len(sec)):
         if h3 in sec[i]:
             tHd = sec[i].replace('<h3>', '').replace('</h3>', '')
             tmp = subCard
             tmp = tmp.replace('[HEADER_ID]', (h_id + str(count))).replace('[BODY_ID]', (b_id + str(count)))
-            tmp = tmp.replace('[SUBSECTION_HEADER]', tHd).replace('[SUBSECTION_CONTENT]', sec[i+1])
             tmp = tmp.replace('[SEC_ACC]', secAcc)
-            content += tmp
+            tmp = tmp.replace('[SUBSECTION_HEADER]', tHd).replace('[SUBSECTION_CONTENT]', sec[i+1])
+            parts.append(tmp)
             count += 1
-    content += secAccClose
+    parts.append(secAccClose)
+    content += ''.join(parts)
     return content
 
 
-def getPass(sn, un):
-    sn = "".join(e for e in sn if e.isalnum())
-    with open('./data/tmp/' + sn + '/students.json', 'r') as f:
+def loadStudents(path):
+    # students.json indexed by username with non alphanumeric characters removed
+    with open(path, 'r') as f:
         data = json.load(f)
-        d1 = data.get(un)[0]
-        p = d1.get('password')
+    return {"".join(e for e in un if e.isalnum()): creds for un, creds in data.items()}
+
+
+# student credentials of each scenario, reloaded when students.json changes
+studentCache = FileCache(loadStudents, maxsize=64)
+
+
+def scenarioStudents(sn):
+    sn = "".join(e for e in sn if e.isalnum())
+    return studentCache.get('./data/tmp/' + sn + '/students.json')
+
+
+def getPass(sn, un):
+    un = "".join(e for e in un if e.isalnum())
+    d1 = scenarioStudents(sn).get(un)[0]
+    p = d1.get('password')
     return p
 
 
 def getQuestions(t):
     questions = {}
     t = t.lower().replace(" ", "_")
-    with open(
-            "./scenarios/prod/" + t + "/" + "questions.yml", "r"
-    ) as yml:  # edurange_refactored/scenarios/prod
-        document = yaml.full_load(yml)
-        for item in document:
-            #questions.append(item['Text'])
-            questions[item['Order']] = item['Text']
+    document = yamlCache.get("./scenarios/prod/" + t + "/" + "questions.yml")  # edurange_refactored/scenarios/prod
+    for item in document:
+        #questions.append(item['Text'])
+        questions[item['Order']] = item['Text']
     return questions
 
 
@@ -442,36 +521,61 @@ def getPort(n):
     return n
 
 
+def scenarioColumns(sid, *columns):
+    # only the given columns of one scenario, e.g. scenarioColumns(sid, Scenarios.name, Scenarios.status)
+    return db.session.query(*columns).filter(Scenarios.id == sid).first()
+
+
+class ScenarioContext(NamedTuple):
+    """What a scenario page needs from the scenarios and users tables."""
+    id: int
+    name: str
+    description: str
+    status: int
+    created_at: datetime
+    attempt: int
+    owner_id: int
+    owner: str  # owner's username
+    username: Optional[str]  # current user's username, None if nobody is logged in
+
+
+def scenarioContext(sid):
+    # scenario and owner in one joined query, cached for the rest of the request
+    identity = currentIdentity()
+    contexts = g.setdefault("scenarioContexts", {})
+    key = str(sid)
+    if key not in contexts:
+        owner = aliased(User)
+        row = db.session.query(Scenarios.id, Scenarios.name, Scenarios.description, Scenarios.status,
+                               Scenarios.created_at, Scenarios.attempt, Scenarios.owner_id, owner.username)\
+            .join(owner, owner.id == Scenarios.owner_id)\
+            .filter(Scenarios.id == sid).first()
+        username = identity.username if identity is not None else None
+        contexts[key] = ScenarioContext(*row, username) if row is not None else None
+    return contexts[key]
+
+
 def tempMaker(d, i):
-    db_ses = db.session
+    ctx = scenarioContext(d)
     # status
-    stat = db_ses.query(Scenarios.status).filter(Scenarios.id == d).first()
-    stat = statReader(stat[0])
+    stat = statReader(ctx.status)
     # owner name
-    oName = (
-        db_ses.query(User.username).filter(Scenarios.id == d).filter(Scenarios.owner_id == User.id).first()
-    )
-    oName = oName[0]
+    oName = ctx.owner
     # description
-    ty = db_ses.query(Scenarios.description).filter(Scenarios.id == d).first()
-    ty = ty[0]
+    ty = ctx.description
     desc = getDesc(ty)
     guide = getGuide(ty)
     questions = getQuestions(ty)
     # current_app.logger.info(questions) #--
     # scenario name
-    sNom = db_ses.query(Scenarios.name).filter(Scenarios.id == d).first()
-    sNom = sNom[0]
+    sNom = ctx.name
     if i == "ins":
         # creation time
-        bTime = db_ses.query(Scenarios.created_at).filter(Scenarios.id == d).first()
-        bTime = bTime[0]
+        bTime = ctx.created_at
         return stat, oName, bTime, desc, ty, sNom, guide, questions
     elif i == "stu":
         # username
-        ud = current_user.id
-        usr = db_ses.query(User.username).filter(User.id == ud).first()[0]
-        usr = "".join(e for e in usr if e.isalnum())
+        usr = "".join(e for e in ctx.username if e.isalnum())
         # password
         pw = getPass(sNom, usr)
         return stat, oName, desc, ty, sNom, usr, pw, guide, questions
@@ -496,54 +600,55 @@ def tempMaker(d, i):
 
 
 def responseCheck(qnum, sid, resp, uid):
-    # read correct response from yaml file
+    # check response against the answers read from the yaml file
     db_ses = db.session
-    s_name = db_ses.query(Scenarios.name).filter(Scenarios.id == sid).first()
-    questions = questionReader(s_name[0])
-    for text in questions:
-        order = int(text['Order'])  # get question number from yml file
-        if order == qnum:
-            if len(text['Values']) == 1:  # if there's only one correct answer in the yml file
-                ans = str(text['Values'][0]['Value'])
-                if "${" in ans:
-                    ans = bashAnswer(sid, uid, ans)
-                if resp == ans:
-                    return int(text['Points'])
-                elif ans == 'ESSAY':
-                    return int(text['Points'])
-                else:
-                    return 0
-            elif len(text['Values']) > 1:  # if there's multiple correct answers in the yml file
-                yes = False
-                for i in text['Values']:
-                    ans = i['Value']
-                    if "${" in ans:
-                        ans = bashAnswer(sid, uid, ans)
-                    if resp == ans:
-                        yes = True
-                if yes:
-                    return int(i['Points'])
-                else:
-                    return 0
+    s_name, s_type = db_ses.query(Scenarios.name, Scenarios.description).filter(Scenarios.id == sid).first()
+    question = scenarioQuestions(s_name, s_type).get(qnum)
+    if question is None or not question.values:
+        return None
+    keys = []
+
+    def resolve(ans):  # templated answers come from the player's stored answer key
+        if not keys:
+            keys.append(answerKey(sid, uid))
+        if keys[0].get(ans) is not None:
+            return keys[0][ans]
+        try:
+            return bashAnswer(sid, uid, ans)  # could not be resolved when the key was stored
+        except (OSError, LookupError, ValueError):
+            return None  # tmp files are gone, nothing to match
+
+    return question.check(resp, resolve)
 
 
 def bashAnswer(sid, uid, ans):
     db_ses = db.session
     uName = db_ses.query(User.username).filter(User.id == uid).first()[0]
-    uName = "".join(e for e in uName if e.isalnum())
     sName = db_ses.query(Scenarios.name).filter(Scenarios.id == sid).first()[0]
+    return expandAnswer(sName, uName, ans)
+
+
+def loadJson(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+# <container>.tf.json files of built scenarios
+tfCache = FileCache(loadJson, maxsize=64)
+
+
+def expandAnswer(sName, uName, ans):
+    # fill in ${...} placeholders of an answer from the scenario's tmp files
+    uName = "".join(e for e in uName if e.isalnum())
     if "${player.login}" in ans:
-        students = open("./data/tmp/" + sName + "/students.json", "r")
-        user = ast.literal_eval(students.read())
-        username = user[uName][0]["username"]
+        username = scenarioStudents(sName)[uName][0]["username"]
         ansFormat = ans[0:6]
         newAns = ansFormat + username
         return newAns
     elif "${scenario.instances" in ans:
         wordIndex = ans[21:-1].index(".")
         containerName = ans[21:21+wordIndex]
-        containerFile = open("./data/tmp/" + sName + "/" + containerName + ".tf.json", "r")
-        content = ast.literal_eval(containerFile.read())
+        content = tfCache.get("./data/tmp/" + sName + "/" + containerName + ".tf.json")
         index = content["resource"][0]["docker_container"][0][sName + "_" + containerName][0]["networks_advanced"]
         ans = ""
         for d in index:
@@ -554,152 +659,97 @@ def bashAnswer(sid, uid, ans):
         return ans
 
 
+def materializeAnswers(sid, uids=None):
+    """Resolve the scenario's templated answers for its players and store them in answer_keys.
+
+    Meant to run once the scenario is built (CreateScenarioTask) so grading does not depend on the
+    tmp files, and on first use for players without a stored key. Returns {user_id: {template: answer}}.
+    The keys are written in a savepoint and committed with the caller's transaction.
+    """
+    db_ses = db.session
+    sName, s_type = db_ses.query(Scenarios.name, Scenarios.description).filter(Scenarios.id == sid).first()
+    templates = {ans for q in scenarioQuestions(sName, s_type) for ans, pts in q.templated}
+    players = db_ses.query(User.id, User.username)
+    if uids is None:
+        players = players.filter(ScenarioGroups.scenario_id == sid, ScenarioGroups.group_id == GroupUsers.group_id,
+                                 GroupUsers.user_id == User.id)
+    else:
+        players = players.filter(User.id.in_(uids))
+    keys = {}
+    rows = []
+    for uid, uName in players.all():
+        resolved = {}
+        for t in templates:
+            try:
+                resolved[t] = expandAnswer(sName, uName, t)
+            except (OSError, LookupError, ValueError):
+                resolved[t] = None  # tmp files missing or incomplete, stored as is so it isn't tried again
+        keys[uid] = resolved
+        rows.extend({'scenario_id': sid, 'user_id': uid, 'template': t, 'answer': a} for t, a in resolved.items())
+    try:
+        with db_ses.begin_nested():
+            if keys:
+                db_ses.query(AnswerKeys).filter(AnswerKeys.scenario_id == sid)\
+                    .filter(AnswerKeys.user_id.in_(list(keys))).delete(synchronize_session=False)
+            if rows:
+                db_ses.bulk_insert_mappings(AnswerKeys, rows)
+    except IntegrityError:
+        # a concurrent first answer stored the same keys, use those
+        return {uid: storedAnswers(sid, uid) for uid in keys}
+    return keys
+
+
+def storedAnswers(sid, uid):
+    return dict(db.session.query(AnswerKeys.template, AnswerKeys.answer)
+                .filter(AnswerKeys.scenario_id == sid).filter(AnswerKeys.user_id == uid).all())
+
+
+def answerKey(sid, uid):
+    # {template: answer or None if it couldn't be resolved} of one player, materialized on first use
+    keys = storedAnswers(sid, uid)
+    if not keys:
+        keys = materializeAnswers(sid, [uid]).get(int(uid), {})
+    return keys
+
+
 # --
 
 
 def responseQuery(uid, att, query, questions):
     tableList = []
-    tmpList = []
-    for entry in query:
-        if entry.user_id == uid and entry.attempt == att:
-            tmpList.append(entry)
-
-    for response in tmpList:
-        qNum = response.question
-        pts = response.points
-        for text in questions:
-            order = int(text['Order'])
-            if order == qNum:
-                quest = text['Text']
-                poi = text['Points']
-                val = text['Values'][0]['Value']
-                sR = response.student_response
-                dictionary = {'number': qNum, 'question': quest, 'answer': val, 'points': poi, 'student_response': sR, 'earned': pts}
+    questions = compileQuestions(questions)
+    for response in query:
+        if response.user_id == uid and response.attempt == att:
+            qNum = response.question
+            q = questions.get(qNum)
+            if q is not None:
+                dictionary = {'number': qNum, 'question': q.text, 'answer': q.answer, 'points': q.points,
+                              'student_response': response.student_response, 'earned': response.points}
                 tableList.append(dictionary)
     return tableList
 
 
-def responseSelector(resp):
-    # response selector
-    db_ses = db.session
-    query = db_ses.query(Responses.id, Responses.user_id, Responses.scenario_id, Responses.attempt).all()
-    for entry in query:
-        if entry.id == int(resp):
-            data = entry
-            break
-    return data
+def responseSelector(resp, sid=None):
+    # response by primary key with its player's and scenario's names, None if there is none (in scenario sid)
+    try:
+        rid = int(resp)
+    except (TypeError, ValueError):
+        return None
+    query = db.session.query(Responses.id, Responses.user_id, Responses.scenario_id, Responses.attempt,
+                             User.username, Scenarios.name.label("scenario_name"))\
+        .join(User, User.id == Responses.user_id)\
+        .join(Scenarios, Scenarios.id == Responses.scenario_id)\
+        .filter(Responses.id == rid)
+    if sid is not None:
+        query = query.filter(Responses.scenario_id == sid)
+    return query.first()
 
 
 # -----
 
-# scoring functions used in functions such as queryPolish()
-# used as:
-# scr = score(getScore(uid, att, query), questionReader(sName))
-
-# required query entries:
-# user_id, attempt, question, correct, student_response
-
-'''
-def getScore(usr, att, query):
-    sL = []  # student response list
-    for resp in query:
-        if usr == resp.user_id and att == resp.attempt:
-            sL.append({'question': resp.question, 'correct': resp.correct, 'response': resp.student_response})  # qnum, correct, student response
-    return sL
-'''
-
 
 def totalScore(questions):
-    tS = 0  # total number of possible points
-    for text in questions:
-        tS += int(text['Points'])
-    return tS
-
-'''
-def score(scrLst, questions):
-    sS = 0  # student score
-    checkList = scoreSetup(questions)  # questions scored checklist
-    for sR in scrLst:  # response in list of student responses
-        if sR['correct']:
-            num = int(sR['question'])  # question number
-            for text in questions:
-                if int(text['Order']) == num:
-                    check, checkList = scoreCheck(num, checkList)
-                    if not check:
-                        if str(text['Type']) == "Multi String":
-                            for i in text['Values']:
-                                if i['Value'] == sR['response']:
-                                    sS += int(text['Values'][i]['Points'])
-                        else:
-                            sS += int(text['Points'])
-    scr = '' + str(sS) + ' / ' + str(totalScore(questions))
-    return scr
-'''
-
-
-def scoreSetup(questions):
-    checkList = {}  # list of question to be answered so duplicates are not scored
-    for text in questions:
-        if str(text['Type']) == "Multi String":
-            # count = 1
-            tmp = []
-            for d in text['Values']:  # d is not used  # it's probably fine (possibly bad practice though)
-                tmp.append(False)
-                # k = str(text['Order']) + '.' + str(count)
-                # checkList[k] = False
-                # count += 1
-            k = str(text['Order'])
-            checkList[k] = tmp
-        else:
-            checkList[str(text['Order'])] = False
-    # bloop()
-    return checkList
-
-
-# {'1': True, '2': False, ... , '6': [True, False, False, ...], '7': False}
-#                                       0    1      2     ...
-
-# if multi string, take student response into account to find the index within '6': [...] and mark true or false as normal
-
-
-def scoreCheck(qnum, checkList):
-    keys = list(checkList.keys())
-    for k in keys:
-        if k == str(qnum):
-            if checkList[k]:
-                return True, checkList  # answer has already been checked
-            elif not checkList[k]:
-                checkList[k] = True
-                return False, checkList  # answer has not been checked before but is now checked
-        elif str(qnum) in k and '.' in k:  # if multi string
-            if checkList[k]:
-                return True, checkList  # answer was already checked
-            elif not checkList[k]:
-                checkList[k] = True
-                return False, checkList  # answer was not checked before but is now
-        #elif str(qnum) in k:
-            #flash("Could not check question {0} with key {1}".format(qnum, k))
-
-    return False, checkList
-
-
-def scoreCheck2(qnum, checkList, resp, quest):
-    keys = list(checkList.keys())
-    for k in keys:
-        if k == str(qnum):
-            if type(checkList[k]) == list:  # if multi string
-                return False
-                # check stu_resp against q.yml
-                #   if stu_resp in q.yml
-                #       if i in q.yml = false in checkList[k][i]
-                #           return true
-                #       else
-            elif type(checkList[k]) == bool:    # if NOT a multi string
-                if checkList[k]:
-                    return True, checkList  # answer has already been checked
-            elif not checkList[k]:
-                checkList[k] = True
-                return False, checkList  # answer has not been checked before but is now checked
+    return compileQuestions(questions).total_points  # total number of possible points
 
 
 # query(Responses.user_id, Responses.attempt, Responses.question, Responses.points, Responses.student_response)
@@ -709,63 +759,50 @@ def scoreCheck2(qnum, checkList, resp, quest):
 
 
 def score(uid, att, query, questions):
-    stuScore = 0
-    checkList = scoreSetup(questions)
-    for resp in query:
-        if resp.user_id == uid and resp.attempt == att:     # if response entry matches uid and attempt number
-            if resp.points > 0:                             # if the student has points i.e. if the student answered correctly
-                qNum = int(resp.question)
-                check, checkList = scoreCheck(qNum, checkList)      # check against checkList with question number
-                if not check:
-                    stuScore += resp.points
-    scr = '' + str(stuScore) + ' / ' + str(totalScore(questions))
+    questions = compileQuestions(questions)
+    # only the first correct answer to each question (each value of a multi string) is counted
+    stuScore, answered = questions.tally(resp for resp in query if resp.user_id == uid and resp.attempt == att)
+    scr = '' + str(stuScore) + ' / ' + str(questions.total_points)
     return scr
 # -----
 
 
 def questionReader(name):
+    # cached, see yamlCache
     name = "".join(e for e in name if e.isalnum())
-    with open(
-            "./data/tmp/" + name + "/questions.yml", "r"
-    ) as yml:
-        document = yaml.full_load(yml)
-    return document
+    return yamlCache.get("./data/tmp/" + name + "/questions.yml")
 
 
 def queryPolish(query, sName):
-    qList = []
-    for entry in query:
-        i = entry.id
-        uid = entry.user_id
-        att = entry.attempt
-        usr = entry.username
-        if qList is None:
-            scr = score(uid, att, query, questionReader(sName))  # score(getScore(uid, att, query), questionReader(sName))
-            d = {'id': i, 'user_id': uid, 'username': usr, 'score': scr, 'attempt': att}
-            qList.append(d)
-        else:
-            error = 0
-            for lst in qList:
-                if uid == lst['user_id'] and att == lst['attempt']:
-                    error += 1
-            if error == 0:
-                scr = score(uid, att, query, questionReader(sName))  # score(getScore(uid, att, query), questionReader(sName))
-                d = {'id': i, 'user_id': uid, 'username': usr, 'score': scr, 'attempt': att}
-                qList.append(d)
-    return qList
+    # one (user, attempt) entry with its score, in the order they appear in the query
+    # empty while the scenario has no questions.yml yet (e.g. still building), like gradebook()
+    if not query:
+        return []
+    try:
+        questions = questionSet(sName)
+    except FileNotFoundError:
+        return []
+    return gradeAttempts(query, questions)
+
+
+def scenarioScores(sid, sName):
+    # same as queryPolish, with the responses grouped by the database first
+    return queryPolish(scenarioAnswers(sid), sName)
 
 
 def responseProcessing(data):
     # response info getter
     db_ses = db.session
-    # user info
+    # user info, names are already there for rows from responseSelector
     uid = data.user_id
-    uname = db_ses.query(User.username).filter(User.id == uid).first()
-    uname = uname[0]
+    uname = getattr(data, "username", None)
+    if uname is None:
+        uname = db_ses.query(User.username).filter(User.id == uid).first()[0]
     # scenario info
     sid = data.scenario_id
-    sname = db_ses.query(Scenarios.name).filter(Scenarios.id == sid).first()
-    sname = sname[0]
+    sname = getattr(data, "scenario_name", None)
+    if sname is None:
+        sname = db_ses.query(Scenarios.name).filter(Scenarios.id == sid).first()[0]
     # response info
     att = data.attempt
     return uid, uname, sid, sname, att
@@ -790,79 +827,83 @@ def getAttempt(sid):
 # returns dictionary of lines with common keyIndex values
 
 
+def catalogEntry(t):
+    # what the catalog shows of a scenario type, None if its yml is missing or incomplete
+    try:
+        doc = scenarioDefinition(t)
+        return {'name': t, 'description': doc["Description"], 'codelab': doc.get("Codelab")}
+    except (FileNotFoundError, KeyError, TypeError, yaml.YAMLError):
+        return None
+
+
+# scenario types in ./scenarios/prod/, parsed in parallel and rebuilt when a pack is added or edited
+catalogIndex = DirectoryIndex("./scenarios/prod/", catalogEntry, scenarioFile)
+
+
 def readScenario():
-    scenarios = [
-        dI
-        for dI in os.listdir("./scenarios/prod/")
-        if os.path.isdir(os.path.join("./scenarios/prod/", dI))
-    ]
-    desc = []
-    for s in scenarios:
-        desc.append(getDesc(s))
-    return 0
-
-
-def recentCorrect(uid, qnum, sid):
+    # {type: catalog entry}
+    return catalogIndex.entries()
+
+
+def latestPoints(*criteria):
+    # {question: points of the most recent response} for the responses matching criteria, in one statement
     db_ses = db.session
-    recent = db_ses.query(Responses.points).filter(Responses.user_id == uid).filter(Responses.scenario_id == sid)\
-        .filter(Responses.question == qnum).order_by(Responses.response_time.desc()).first()
-    return recent
+    if db.engine.dialect.name == "postgresql":
+        query = db_ses.query(Responses.question, Responses.points).filter(*criteria)\
+            .distinct(Responses.question).order_by(Responses.question, Responses.response_time.desc())
+    else:  # no DISTINCT ON, join against the latest response_time of each question instead
+        latest = db_ses.query(Responses.question, func.max(Responses.response_time).label("response_time"))\
+            .filter(*criteria).group_by(Responses.question).subquery()
+        query = db_ses.query(Responses.question, Responses.points).filter(*criteria)\
+            .join(latest, and_(Responses.question == latest.c.question, Responses.response_time == latest.c.response_time))
+    return {r.question: r.points for r in query}
 
 
 def displayCorrect(sName, uName):
-    db_ses = db.session
-    uid = db_ses.query(User.id).filter(User.username == uName).first()
-    sid = db_ses.query(Scenarios.id).filter(Scenarios.name == sName).first()
-    questions = questionReader(sName)
+    recent = latestPoints(Responses.user_id == User.id, User.username == uName,
+                          Responses.scenario_id == Scenarios.id, Scenarios.name == sName)
     ques = {}
-    for text in questions:
-        order = int(text['Order'])
-        rec = recentCorrect(uid, order, sid)
-        if rec is not None:
-            rec = rec[0]
-        ques[order] = rec
+    for q in questionSet(sName):
+        ques[q.order] = recent.get(q.order)
     return ques
 
 
 def displayProgress(sid, uid):
     db_ses = db.session
-    att = getAttempt(sid)
-    sName = db_ses.query(Scenarios.name).filter(Scenarios.id == sid).first()
-    query = db_ses.query(Responses.attempt, Responses.question, Responses.points, Responses.student_response, Responses.scenario_id, Responses.user_id)\
-        .filter(Responses.scenario_id == sid).filter(Responses.user_id == uid).all()
-    questions = questionReader(sName.name)
-    answered, tQuest = getProgress(query, questions)
-    scr, tScr = calcScr(uid, sid, att)  # score(uid, att, query, questionReader(sName))  # score(getScore(uid, att, query), questionReader(sName))
-    progress = {'questions': answered, 'total_questions': tQuest, 'score': scr, 'total_score': tScr}
+    sName, att, s_type = db_ses.query(Scenarios.name, Scenarios.attempt, Scenarios.description)\
+        .filter(Scenarios.id == sid).first()
+    questions = scenarioQuestions(sName, s_type)
+    # first correct answer to each question counts, as in score() and the instructor's tables
+    answered, scr = attemptProgress(uid, sid, att, questions)  # kept up to date by progress_utils.recordResponse
+    progress = {'questions': answered, 'total_questions': len(questions), 'score': scr, 'total_score': questions.total_points}
     return progress
 
 
-def calcScr(uid, sid, att):
-    score = 0
-    db_ses = db.session
-    sName = db_ses.query(Scenarios.name).filter(Scenarios.id == sid).first()
-    query = db_ses.query(Responses.points, Responses.question).filter(Responses.scenario_id == sid).filter(Responses.user_id == uid)\
-        .filter(Responses.attempt == att).order_by(Responses.response_time.desc()).all()
-    checkList = scoreSetup(questionReader(sName.name))
-    for r in query:
-        check, checkList = scoreCheck(r.question, checkList)
-        if not check:
-            score += int(r.points)
-    # score = '' + str(score) + ' / ' + str(totalScore(questionReader(sName)))
-    tScore = totalScore(questionReader(sName.name))
-    return score, tScore
-
-
-def getProgress(query, questions):
-    checkList = scoreSetup(questions)
-    corr = 0
-    total = list(checkList.keys())[-1]
-    for resp in query:
-        if int(resp.points) > 0:
-            q = int(resp.question)
-            check, checkList = scoreCheck(q, checkList)
-            if not check:
-                corr += 1
-    # progress = "" + str(corr) + " / " + str(total)
-    return corr, total
+def usersPerGroup(groups, *criteria):
+    # {group name: [members]} for the given groups from one joined query, criteria narrow down the groups queried
+    members = {g.name: [] for g in groups}
+    query = db.session.query(StudentGroups.name.label("group_name"), User.id, User.username, User.email, User.is_static)\
+        .filter(StudentGroups.id == GroupUsers.group_id, GroupUsers.user_id == User.id)\
+        .filter(*criteria).order_by(GroupUsers.id)
+    for row in query:
+        members.setdefault(row.group_name, []).append(row)
+    return members
+
+
+def groupMemberPage(gid, page, per_page):
+    # one page of a group's members and the group's member count
+    query = db.session.query(User.id, User.username, User.email, User.is_static)\
+        .filter(GroupUsers.group_id == gid, GroupUsers.user_id == User.id)
+    total = query.count()
+    members = query.order_by(GroupUsers.id).limit(per_page).offset((max(page, 1) - 1) * per_page).all()
+    return members, total
+
+
+# rendered command graphs by (scenario, username), rebuilt only when the scenario's log has grown
+graphCache = VersionedCache(maxsize=256)
+
 
+def cachedGraph(sName, uName):
+    logs = historyPath(sName)
+    offset = os.path.getsize(logs) if logs is not None and os.path.isfile(logs) else None
+    return graphCache.lookup((sName, uName), offset, lambda stale: getGraph(sName, uName))
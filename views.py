@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 """User views."""
+import json
 import os
 import shutil
 from flask import (
     Blueprint,
+    Response,
     abort,
     flash,
     redirect,
@@ -12,9 +14,12 @@ from flask import (
     session,
     url_for,
     current_app,
-    send_from_directory
+    has_request_context,
+    jsonify,
+    stream_with_context
 )
 from flask_login import login_required
+from sqlalchemy import func
 
 from edurange_refactored.extensions import db
 from edurange_refactored.user.forms import (
@@ -28,29 +33,50 @@ from edurange_refactored.user.forms import (
     scenarioResponseForm
 )
 
+from ..cache_utils import VersionedCache
 from ..form_utils import process_request
+from ..gradebook_utils import gradebookResponse
+from ..pagination_utils import keysetPage
+from ..provision_utils import generatedUsers, provisionGroup
 from ..scenario_utils import identify_state, identify_type, populate_catalog
+from ..status_utils import ACTIONS, bulkLifecycle, statusEvents
 from ..tasks import CreateScenarioTask
 from ..utils import (
+    cachedGraph,
+    catalogIndex,
     check_role_view,
     checkAuth,
     flash_errors,
+    format_datetime,
     tempMaker,
     responseProcessing,
     responseQuery,
     responseSelector,
-    queryPolish,
-    questionReader,
+    scenarioScores,
+    questionSet,
     # getScore,
     score,
     displayCorrect,
-    displayProgress
+    displayProgress,
+    groupMemberPage,
+    scenarioColumns,
+    navElements,
+    usersPerGroup,
+    warmNav
+)
+from ..role_utils import checkEx, checkEnr
+from ..identity_utils import requireAdmin, requireInstructor, requirePrivs
+from ..history_utils import (
+    historyDict,
+    historyFirstPages,
+    historyPath,
+    historyResponse,
+    ingestLater,
+    logResponse,
+    playerHistory
 )
-from ..role_utils import check_admin, check_instructor, check_privs, checkEx, return_roles, checkEnr
-from ..graph_utils import getGraph, getLogFile
-from ..csv_utils import readCSV, groupCSV
 
-from .models import GroupUsers, ScenarioGroups, Scenarios, StudentGroups, User, Responses, Notification
+from .models import BashHistory, GroupUsers, ScenarioGroups, Scenarios, StudentGroups, User, Responses, Notification
 
 blueprint = Blueprint(
     "dashboard", __name__, url_prefix="/dashboard", static_folder="../static"
@@ -198,11 +224,14 @@ def student_scenario(i):
 # ---- scenario routes
 
 
+catalogCache = VersionedCache(maxsize=1)  # populate_catalog() for the current catalogIndex version
+
+
 @blueprint.route("/catalog", methods=["GET"])
 @login_required
 def catalog():
-    check_privs()
-    scenarios = populate_catalog()
+    requirePrivs()
+    scenarios = catalogCache.lookup("catalog", catalogIndex.refresh(), lambda stale: list(populate_catalog()))
     groups = StudentGroups.query.all()
     scenarioModder = modScenarioForm(request.form)  # type2Form()  #
 
@@ -214,7 +243,7 @@ def catalog():
 @blueprint.route("/make_scenario", methods=["POST"])
 @login_required
 def make_scenario():
-    check_privs()
+    requirePrivs()
     form = makeScenarioForm(request.form)  # type2Form()  #
     if form.validate_on_submit():
         db_ses = db.session
@@ -231,10 +260,8 @@ def make_scenario():
             .all()
         )
 
-        Scenarios.create(name=name, description=s_type, owner_id=own_id)
-        s_id = db_ses.query(Scenarios.id).filter(Scenarios.name == name).first()
-        scenario = Scenarios.query.filter_by(id=s_id).first()
-        scenario.update(status=7)
+        scenario = Scenarios.create(name=name, description=s_type, owner_id=own_id, status=7)
+        s_id = {'id': scenario.id}
         g_id = (
             db_ses.query(StudentGroups.id).filter(StudentGroups.name == group).first()
         )
@@ -246,7 +273,6 @@ def make_scenario():
 
         for i, s in enumerate(students):
             students[i] = s._asdict()
-        s_id = s_id._asdict()
         g_id = g_id._asdict()
 
         CreateScenarioTask.delay(name, s_type, own_id, students, g_id, s_id)
@@ -266,15 +292,14 @@ def make_scenario():
 @login_required
 def scenarios():
     """List of scenarios and scenario controls"""
-    check_privs()
+    requirePrivs()
     scenarioModder = modScenarioForm()  # type2Form()  #
-    scenarios = Scenarios.query.all()
     groups = StudentGroups.query.all()
+    # rows are fetched by the page from dashboard.scenarioList
 
     if request.method == "GET":
         return render_template(
             "dashboard/scenarios.html",
-            scenarios=scenarios,
             scenarioModder=scenarioModder,
             groups=groups,
         )
@@ -283,7 +308,6 @@ def scenarios():
         process_request(request.form)
         return render_template(
             "dashboard/scenarios.html",
-            scenarios=scenarios,
             scenarioModder=scenarioModder,
             groups=groups,
         )
@@ -292,27 +316,22 @@ def scenarios():
 @blueprint.route("/scenarios/<i>")
 def scenariosInfo(i):
     # i = scenario_id
-    admin, instructor = return_roles()
-    if not admin and not instructor:
-        return abort(403)
+    requirePrivs()
     status, owner, bTime, desc, s_type, s_name, guide, questions = tempMaker(i, "ins")
     addresses = identify_state(s_name, status)
     db_ses = db.session
-    query = db_ses.query(Responses.id, Responses.user_id, Responses.attempt, Responses.points,
-                         Responses.question, Responses.student_response, Responses.scenario_id, User.username)\
-        .filter(Responses.scenario_id == i).filter(Responses.user_id == User.id).all()
-    resp = queryPolish(query, s_name)
-    try:
-        rc = readCSV(i)
-    except FileNotFoundError:
+    resp = scenarioScores(i, s_name)
+    logs = historyPath(s_name)
+    if logs is not None and os.path.isfile(logs):
+        ingestLater(s_name)  # copies the lines added since the last visit without holding up the page
+    else:
         flash("Log file '{0}.csv' was not found, has anyone played yet? - ".format(s_name))
-        rc = []
 
     gid = db_ses.query(StudentGroups.id).filter(Scenarios.id == i, ScenarioGroups.scenario_id == Scenarios.id, ScenarioGroups.group_id == StudentGroups.id).first()
     players = db_ses.query(User.username).filter(GroupUsers.group_id == StudentGroups.id, StudentGroups.id == gid, GroupUsers.user_id == User.id).all()
 
-    u_logs = groupCSV(rc, 4) # make dictionary using 6th value as key (player name)
-
+    # first page of each player's log, the rest is fetched from dashboard.playerLogs with the player's cursor
+    u_logs, u_cursors = historyFirstPages(s_name)
 
     return render_template("dashboard/scenarios_info.html",
                            i=i,
@@ -326,9 +345,26 @@ def scenariosInfo(i):
                            guide=guide,
                            questions=questions,
                            resp=resp,
-                           rc=rc, # rc may not be needed with individual user logs in place
+                           rc=[], # individual user logs are paged, see playerLogs
                            players=players,
-                           u_logs=u_logs)
+                           u_logs=u_logs,
+                           u_cursors=u_cursors)
+
+
+@blueprint.route("/scenarios/<i>/logs/<u>")
+def playerLogs(i, u):
+    # i = scenario_id, u = player name in the log
+    # one page of a player's commands, oldest first; ?after= is the cursor of the previous page, ?q= filters commands
+    if checkAuth(i):
+        if checkEx(i):
+            scenario = scenarioColumns(i, Scenarios.name)[0]
+            rows, cursor = keysetPage(playerHistory(scenario, u), {"timestamp": BashHistory.timestamp}, BashHistory.id,
+                                      "timestamp", order="asc", search=BashHistory.input)
+            return jsonify(next=cursor, rows=[historyDict(r) for r in rows])
+        else:
+            return abort(404)
+    else:
+        return abort(403)
 
 
 @blueprint.route("/scenarios/<i>/<r>")
@@ -337,14 +373,18 @@ def scenarioResponse(i, r):
     if checkAuth(i):
         if checkEx(i):
             db_ses = db.session
-            d = responseSelector(r)
+            d = responseSelector(r, i)
+            if d is None:
+                return abort(404)
             u_id, uName, s_id, sName, aNum = responseProcessing(d)
             # s_type = db_ses.query(Scenarios.description).filter(Scenarios.id == s_id).first()
             query = db_ses.query(Responses.id, Responses.user_id, Responses.attempt, Responses.question,
                                  Responses.points, Responses.student_response, User.username)\
-                .filter(Responses.scenario_id == i).filter(Responses.user_id == User.id).filter(Responses.attempt == aNum).all()
-            table = responseQuery(u_id, aNum, query, questionReader(sName))
-            scr = score(u_id, aNum, query, questionReader(sName))  # score(getScore(u_id, aNum, query), questionReader(sName))
+                .filter(Responses.scenario_id == i).filter(Responses.user_id == User.id)\
+                .filter(Responses.user_id == u_id).filter(Responses.attempt == aNum).all()
+            questions = questionSet(sName)
+            table = responseQuery(u_id, aNum, query, questions)
+            scr = score(u_id, aNum, query, questions)  # score(getScore(u_id, aNum, query), questionReader(sName))
 
             return render_template("dashboard/scenario_response.html",
                                    i=i,
@@ -361,14 +401,27 @@ def scenarioResponse(i, r):
         return abort(403)
 
 
+@blueprint.route("/scenarios/<i>/gradebook")
+@login_required
+def scenarioGradebook(i):
+    """Scores of every attempt of a scenario, ?format=csv (default) or parquet"""
+    identity = requirePrivs()
+    scenario = scenarioColumns(i, Scenarios.id, Scenarios.name, Scenarios.description, Scenarios.owner_id)
+    if scenario is None:
+        return abort(404)
+    if not identity.is_admin and str(scenario.owner_id) != str(identity.id):
+        return abort(403)  # instructors only see their own scenarios
+    return gradebookResponse([(scenario.id, scenario.name, scenario.description)], scenario.name + "-gradebook",
+                             request.args.get("format", "csv"))
+
+
 @blueprint.route("/scenarios/<i>/graphs/<u>")
 def scenarioGraph(i, u):
     # i = scenario_id, u = username
     if checkAuth(i):
         if checkEx(i):
-            db_ses = db.session
-            scenario = db_ses.query(Scenarios.name).filter(Scenarios.id == i).first()[0]
-            graph = getGraph(scenario, u)
+            scenario = scenarioColumns(i, Scenarios.name)[0]
+            graph = cachedGraph(scenario, u)
             if graph:
                 return render_template("dashboard/graphs.html", graph=graph)
             else:
@@ -384,21 +437,18 @@ def scenarioGraph(i, u):
 @blueprint.route("/scenarios/<i>/getLogs")
 def getLogs(i):
     # i = scenario_id
+    # ?user=, ?start= and ?end= (ISO times) export matching commands from bash_history, ?gzip=1 compresses the log
     if checkAuth(i):
         if checkEx(i):
-            db_ses = db.session
-            scenario = db_ses.query(Scenarios.name).filter(Scenarios.id == i).first()[0]
-            logs = getLogFile(scenario)
-            if logs is not None:
-                # with open(logs[3:]) as fin, open('tmp.csv', 'w') as fout:
-                #     for line in fin:
-                #         fout.write(line.replace('\t', ','))
-                # shutil.copy('tmp.csv', logs[3:])
-                # os.remove('tmp.csv')
+            scenario = scenarioColumns(i, Scenarios.name)[0]
+            logs = historyPath(scenario)
+            if logs is not None and os.path.isfile(logs):
+                user, start, end = request.args.get("user"), request.args.get("start"), request.args.get("end")
+                if user or start or end:
+                    ingestLater(scenario)  # catch the table up for the next export
+                    return historyResponse(scenario, user, start, end)
                 fname = logs.rsplit('/', 1)[-1] # 'ScenarioName-history.csv'
-                logs = logs.rsplit('/', 1)[0] # '../data/tmp/ScenarioName/'
-
-                return send_from_directory(logs, fname, as_attachment=True)
+                return logResponse(logs, fname)
             else:
                 flash("Log file for scenario {0} could not be found.".format(scenario))
                 return redirect(url_for('dashboard.scenariosInfo', i=i))
@@ -415,7 +465,7 @@ def getLogs(i):
 @login_required
 def instructor():
     """List of an instructors groups"""
-    check_instructor()
+    requireInstructor()
     # Queries for the owned groups table
     curId = session.get("_user_id")
     db_ses = db.session
@@ -423,15 +473,8 @@ def instructor():
     students = db_ses.query(User.id, User.username, User.email, User.is_static).filter(User.is_instructor == False)
     groups = db_ses.query(
         StudentGroups.id, StudentGroups.name, StudentGroups.code
-    ).filter(StudentGroups.owner_id == curId)
-    users_per_group = {}
-
-    for g in groups:
-        users_per_group[g.name] = db_ses.query(User.id, User.username, User.email, User.is_static).filter(
-            StudentGroups.name == g.name,
-            StudentGroups.id == GroupUsers.group_id,
-            GroupUsers.user_id == User.id,
-        )
+    ).filter(StudentGroups.owner_id == curId).all()
+    users_per_group = usersPerGroup(groups, StudentGroups.owner_id == curId)
 
     if request.method == "GET":
         groupMaker = GroupForm()
@@ -469,24 +512,13 @@ def instructor():
 @login_required
 def admin():
     """List of all students and groups. Group, student, and instructor management forms"""
-    check_admin()
+    requireAdmin()
     db_ses = db.session
     # Queries for the tables of students and groups
     students = db_ses.query(User.id, User.username, User.email, User.is_static).filter(User.is_instructor == False)
     instructors = db_ses.query(User.id, User.username, User.email).filter(User.is_instructor == True)
     groups = StudentGroups.query.all()
-    groupNames = []
-    users_per_group = {}
-
-    for g in groups:
-        groupNames.append(g.name)
-
-    for name in groupNames:
-        users_per_group[name] = db_ses.query(User.id, User.username, User.email, User.is_static).filter(
-            StudentGroups.name == name,
-            StudentGroups.id == GroupUsers.group_id,
-            GroupUsers.user_id == User.id,
-        )
+    users_per_group = usersPerGroup(groups)
 
     if request.method == "GET":
         groupMaker = GroupForm()
@@ -526,16 +558,157 @@ def admin():
             return redirect(url_for("dashboard.admin"))
 
 
+@blueprint.route("/groups/<gid>/members", methods=["GET"])
+@login_required
+def groupMembers(gid):
+    """One page of a group's members, for loading large groups on demand"""
+    identity = requirePrivs()
+    owner = db.session.query(StudentGroups.owner_id).filter(StudentGroups.id == gid).first()
+    if owner is None:
+        return abort(404)
+    if not identity.is_admin and str(owner[0]) != str(identity.id):
+        return abort(403)  # instructors only see their own groups
+    page = max(1, request.args.get("page", 1, type=int))
+    per_page = max(1, min(request.args.get("per_page", 50, type=int), 500))
+    members, total = groupMemberPage(gid, page, per_page)
+    return jsonify(page=page, per_page=per_page, total=total,
+                   members=[{"id": m.id, "username": m.username, "email": m.email, "is_static": m.is_static}
+                            for m in members])
+
+
+@blueprint.route("/groups/<gid>/gradebook", methods=["GET"])
+@login_required
+def groupGradebook(gid):
+    """Scores of every attempt of every scenario of a group, ?format=csv (default) or parquet"""
+    identity = requirePrivs()
+    group = db.session.query(StudentGroups.name, StudentGroups.owner_id).filter(StudentGroups.id == gid).first()
+    if group is None:
+        return abort(404)
+    if not identity.is_admin and str(group.owner_id) != str(identity.id):
+        return abort(403)  # instructors only see their own groups
+    scenarios = db.session.query(Scenarios.id, Scenarios.name, Scenarios.description)\
+        .filter(Scenarios.id == ScenarioGroups.scenario_id).filter(ScenarioGroups.group_id == gid)\
+        .distinct().order_by(Scenarios.id).all()
+    return gradebookResponse([tuple(s) for s in scenarios], group.name + "-gradebook",
+                             request.args.get("format", "csv"))
+
+
+@blueprint.route("/groups/provision", methods=["POST"])
+@login_required
+def provisionGroups():
+    """Create a generated group of group_size static users, streaming progress as one json object per line"""
+    requirePrivs()
+    name = request.form.get("group_name", "").strip()
+    size = request.form.get("group_size", 0, type=int)
+    if not name or len(name) > 40 or not 0 < size <= 1000:
+        return abort(400)
+    progress = provisionGroup(name, session.get("_user_id"), generatedUsers(name, size))
+    return Response(stream_with_context(json.dumps(p) + "\n" for p in progress), mimetype="application/x-ndjson")
+
+
 # routing for notification page
 @blueprint.route("/notification")
 @login_required
 def notification():
     """Notification"""
-    notifications = Notification.query.all()
+    # rows are fetched by the page from dashboard.notificationList
+    return render_template("dashboard/notification.html")
+
+
+# ---- paginated table data, see pagination_utils.keysetPage for the arguments
+
+
+@blueprint.route("/api/scenarios", methods=["GET"])
+@login_required
+def scenarioList():
+    requirePrivs()
+    query = db.session.query(Scenarios.id, Scenarios.name, Scenarios.description, Scenarios.created_at,
+                             Scenarios.status, User.username.label("owner"))\
+        .filter(Scenarios.owner_id == User.id)
+    sorts = {
+        "name": Scenarios.name,
+        "description": func.coalesce(Scenarios.description, ""),
+        "owner": User.username,
+        "created_at": Scenarios.created_at,
+        "status": Scenarios.status,
+    }
+    rows, cursor = keysetPage(query, sorts, Scenarios.id, "created_at", search=Scenarios.name)
+    return jsonify(next=cursor, rows=[{
+        "id": s.id,
+        "name": s.name,
+        "description": s.description,
+        "owner": s.owner,
+        "created_at": format_datetime(s.created_at, "%d-%m-%Y %I:%M"),
+        "status": s.status,
+    } for s in rows])
+
+
+@blueprint.route("/api/scenarios/status", methods=["GET"])
+@login_required
+def scenarioStatusStream():
+    """Server-sent events with scenario status changes, see status_utils.statusEvents"""
+    requirePrivs()
+    response = Response(stream_with_context(statusEvents()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # nginx would hold the events back
+    return response
+
+
+@blueprint.route("/api/scenarios/bulk", methods=["POST"])
+@login_required
+def scenarioBulk():
+    """Start, stop or destroy many scenarios at once: {"action": "start", "ids": [1, 2, ...]}"""
+    identity = requirePrivs()
+    data = request.get_json(silent=True) or {}
+    action = data.get("action")
+    ids = data.get("ids")
+    if action not in ACTIONS or not isinstance(ids, list) or not ids or len(ids) > 500:
+        return abort(400)
+    try:
+        ids = [int(i) for i in ids]
+    except (TypeError, ValueError):
+        return abort(400)
+    # instructors only act on their own scenarios
+    return jsonify(bulkLifecycle(action, ids, owner_id=None if identity.is_admin else identity.id))
+
+
+@blueprint.route("/api/catalog/stats", methods=["GET"])
+@login_required
+def catalogStats():
+    """Catalog index build times, see cache_utils.DirectoryIndex.stats"""
+    requireAdmin()
+    return jsonify(index=catalogIndex.stats(), cache=catalogCache.stats())
+
+
+@blueprint.route("/api/students", methods=["GET"])
+@login_required
+def studentList():
+    requirePrivs()
+    query = db.session.query(User.id, User.username, User.email, User.is_static).filter(User.is_instructor == False)
+    sorts = {"username": User.username, "email": User.email, "id": User.id}
+    rows, cursor = keysetPage(query, sorts, User.id, "username", order="asc", search=User.username)
+    return jsonify(next=cursor, rows=[{"id": u.id, "username": u.username, "email": u.email, "is_static": u.is_static}
+                                      for u in rows])
+
+
+@blueprint.route("/api/notifications", methods=["GET"])
+@login_required
+def notificationList():
+    query = db.session.query(Notification.id, Notification.detail, Notification.date)
+    sorts = {"date": Notification.date, "detail": Notification.detail}
+    rows, cursor = keysetPage(query, sorts, Notification.id, "date", search=Notification.detail)
+    return jsonify(next=cursor, rows=[{"id": n.id, "detail": n.detail, "date": str(n.date)} for n in rows])
+
+
+@blueprint.app_context_processor
+def navContext():
+    # {{ navigation.views }} / {{ navigation.links }} for the logged in user, from the request's identity
+    if not has_request_context():  # e.g. templates rendered by a task, there is no user or url to build
+        return {}
+    return {"navigation": navElements()}
 
-    #return render_template("dashboard/notification.html")
-    return render_template(
-        "dashboard/notification.html",
-        notifications=notifications
-    )
 
+@blueprint.record_once
+def buildNav(state):
+    # sidebar and view dropdown markup is built once per process, see utils.generateNavElements
+    warmNav(state.app)